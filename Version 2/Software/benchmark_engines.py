@@ -0,0 +1,40 @@
+"""Benchmark of simulated vehicles per second for each optimiser engine.
+
+Run with: python benchmark_engines.py [envTime] [iterations]
+
+Author: Edward Upton (engiego)
+        Ben Dodd (mitgobla)
+"""
+
+import sys
+import time
+
+import numpy as np
+
+import traffic_env_batch
+import traffic_env_optimising
+
+ENV_DATA = {'lightDistance': 30,
+            'speed': 20,
+            'timeUpQueue': 2,
+            'lightData': [{'busyness': 0.2, 'sensorSensitivity': 2},
+                          {'busyness': 0.2, 'sensorSensitivity': -1}]}
+LIGHT_GREEN_TIME = 30
+
+
+def benchmark(envTime, iterations):
+    vehiclesPerIteration = envTime * sum(lightData['busyness'] for lightData in ENV_DATA['lightData'])
+    for engine in traffic_env_optimising.ENGINES:
+        startTime = time.perf_counter()
+        if engine == 'batch':
+            waitingTimes = traffic_env_batch.run_batch(ENV_DATA, [LIGHT_GREEN_TIME] * iterations, envTime)
+        else:
+            waitingTimes = [[waitingTimeStats.mean for waitingTimeStats in traffic_env_optimising.run_replication(ENV_DATA, LIGHT_GREEN_TIME, envTime, engine)[0]] for iter in range(iterations)]
+        wallTime = time.perf_counter() - startTime
+        print("{:<8} mean wait: {:6.2f}s, wall time: {:6.2f}s, vehicles/second: {:>10.0f}".format(
+            engine, float(np.mean(waitingTimes)), wallTime, vehiclesPerIteration * iterations / wallTime))
+
+
+if __name__ == '__main__':
+    benchmark(int(sys.argv[1]) if len(sys.argv) > 1 else 5000,
+              int(sys.argv[2]) if len(sys.argv) > 2 else 10)
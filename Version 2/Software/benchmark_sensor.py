@@ -0,0 +1,76 @@
+"""Benchmark of the event driven movement sensor against the old 0.1 s polling.
+
+Run with: python benchmark_sensor.py [envTime]
+
+Author: Edward Upton (engiego)
+        Ben Dodd (mitgobla)
+"""
+
+import sys
+import time
+
+import salabim as sim
+
+import traffic_env_optimising
+
+ENV_DATA = {'lightDistance': 30,
+            'speed': 20,
+            'timeUpQueue': 2,
+            'lightData': [{'busyness': 0.2, 'sensorSensitivity': 2},
+                          {'busyness': 0.2, 'sensorSensitivity': 2}]}
+LIGHT_GREEN_TIME = 30
+
+EventLight = traffic_env_optimising.Light
+
+
+class PollingLight(EventLight):
+    # The movement sensor as it was before, checking the queue every 0.1 seconds.
+
+    def setup(self, sensitivity, busyness, recordDepartures=False):
+        EventLight.setup(self, -1, busyness, recordDepartures)
+        self.pollingSensitivity = sensitivity
+
+    def process(self):
+        while True:
+            if self.pollingSensitivity == -1:
+                pass
+            else:
+                if len(self.vehiclesQueue) == 0:
+                    yield self.hold(self.pollingSensitivity)
+                    if len(self.vehiclesQueue) == 0:
+                        self.movementState.set('none')
+                elif len(self.vehiclesQueue) > 0:
+                    self.movementState.set('movement')
+            yield self.hold(0.1)
+
+
+def run_counted(envData, envTime):
+    env = sim.Environment(trace=False, random_seed=1)
+    eventCount = [0]
+    step = env.step
+
+    def counted_step():
+        eventCount[0] += 1
+        step()
+
+    env.step = counted_step
+    startTime = time.perf_counter()
+    traffic_env_optimising.TrafficEnvironment(envData, LIGHT_GREEN_TIME)
+    env.run(envTime)
+    return eventCount[0], time.perf_counter() - startTime
+
+
+def benchmark(envTime):
+    for sensorSensitivity in [2, -1]:
+        envData = dict(ENV_DATA, lightData=[dict(lightData, sensorSensitivity=sensorSensitivity) for lightData in ENV_DATA['lightData']])
+        for lightClass in [PollingLight, EventLight]:
+            traffic_env_optimising.Light = lightClass
+            try:
+                eventCount, wallTime = run_counted(envData, envTime)
+            finally:
+                traffic_env_optimising.Light = EventLight
+            print("Sensor {:>2}, {:<12} events: {:>8}, wall time: {:.2f}s".format(sensorSensitivity, lightClass.__name__, eventCount, wallTime))
+
+
+if __name__ == '__main__':
+    benchmark(int(sys.argv[1]) if len(sys.argv) > 1 else 5000)
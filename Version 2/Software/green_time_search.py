@@ -0,0 +1,130 @@
+"""Search strategies for the light green time and the offsets between sites.
+
+Author: Edward Upton (engiego)
+        Ben Dodd (mitgobla)
+"""
+
+import math
+
+GOLDEN_RATIO = (math.sqrt(5) - 1) / 2
+# Green times are rounded to this so repeated points can share results.
+SEARCH_RESOLUTION = 0.01
+SEARCH_TOLERANCE = 0.5
+# Each refinement level divides the step by this.
+REFINE_FACTOR = 4
+# Most passes a coordinate search makes over every coordinate.
+COORDINATE_PASSES = 3
+
+
+def round_green_time(lightGreenTime):
+    return round(round(lightGreenTime / SEARCH_RESOLUTION) * SEARCH_RESOLUTION, 2)
+
+
+def golden_section_search(evaluate, lower, upper, tolerance=SEARCH_TOLERANCE):
+    """Minimise evaluate over [lower, upper], assuming it is close to unimodal.
+
+    evaluate should use common random numbers so comparisons between green
+    times are not swamped by noise. Returns the best green time and its value.
+    """
+    def evaluate_rounded(lightGreenTime):
+        lightGreenTime = round_green_time(lightGreenTime)
+        return lightGreenTime, evaluate(lightGreenTime)
+
+    left, leftValue = evaluate_rounded(upper - GOLDEN_RATIO * (upper - lower))
+    right, rightValue = evaluate_rounded(lower + GOLDEN_RATIO * (upper - lower))
+    while upper - lower > tolerance:
+        if leftValue <= rightValue:
+            upper, right, rightValue = right, left, leftValue
+            left, leftValue = evaluate_rounded(upper - GOLDEN_RATIO * (upper - lower))
+        else:
+            lower, left, leftValue = left, right, rightValue
+            right, rightValue = evaluate_rounded(lower + GOLDEN_RATIO * (upper - lower))
+    if leftValue <= rightValue:
+        return left, leftValue
+    return right, rightValue
+
+
+def grid_points(lower, upper, step):
+    count = int(math.floor((upper - lower) / step + 1e-9))
+    return [round_green_time(lower + pointNum * step) for pointNum in range(count + 1)]
+
+
+def refine_search(evaluate_many, lower, upper, step, tolerance=SEARCH_TOLERANCE, factor=REFINE_FACTOR):
+    """Sweep [lower, upper] at step, then repeatedly sweep a finer grid around the best point.
+
+    evaluate_many takes a list of green times and returns their values, it is only
+    given points that no earlier level evaluated. Stops once the step is within
+    tolerance and returns the best green time and its value.
+    """
+    evaluated = {}
+    levelLower, levelUpper = lower, upper
+    while True:
+        newPoints = [point for point in grid_points(levelLower, levelUpper, step) if point not in evaluated]
+        if newPoints:
+            evaluated.update(zip(newPoints, evaluate_many(newPoints)))
+        best = min(evaluated, key=evaluated.get)
+        if step <= tolerance:
+            return best, evaluated[best]
+        levelLower, levelUpper = max(lower, best - step), min(upper, best + step)
+        step /= factor
+
+
+def pattern_search(evaluate_many, lower, upper, dimensions, step, tolerance=SEARCH_TOLERANCE, start=None):
+    """Minimise over green splits with every one of dimensions green times in [lower, upper].
+
+    A compass search from start, by default every green time in the middle of
+    the range. Each poll tries a step either way on every green time, 2 * dimensions
+    points that evaluate_many is given together, and moves to the best of them if
+    it improves, otherwise the step is halved. A grid would need a number of points
+    to the power of dimensions. Stops once the step is within tolerance and
+    returns the best green split and its value.
+    """
+    evaluated = {}
+
+    def evaluate_new(points):
+        newPoints = [point for point in dict.fromkeys(points) if point not in evaluated]
+        if newPoints:
+            evaluated.update(zip(newPoints, evaluate_many(newPoints)))
+
+    if start is None:
+        start = (round_green_time((lower + upper) / 2),) * dimensions
+    centre = tuple(round_green_time(greenTime) for greenTime in start)
+    evaluate_new([centre])
+    while True:
+        poll = []
+        for dimension in range(dimensions):
+            for direction in (-1, 1):
+                point = list(centre)
+                point[dimension] = round_green_time(min(max(centre[dimension] + direction * step, lower), upper))
+                poll.append(tuple(point))
+        evaluate_new(poll)
+        best = min(poll, key=evaluated.get)
+        if evaluated[best] < evaluated[centre]:
+            centre = best
+        elif step <= tolerance:
+            return centre, evaluated[centre]
+        else:
+            step /= 2
+
+
+def coordinate_search(evaluate_many, start, coordinatePoints, passes=COORDINATE_PASSES):
+    """Minimise one coordinate at a time, each over its own list of points.
+
+    All the points of a coordinate are given to evaluate_many together with the
+    other coordinates held at the best so far. Passes over every coordinate
+    repeat until one changes nothing or there have been passes of them.
+    Returns the best point and its value.
+    """
+    evaluated = {}
+    best = tuple(start)
+    for passNum in range(passes):
+        previousBest = best
+        for coordinate, points in enumerate(coordinatePoints):
+            candidates = list(dict.fromkeys([best] + [best[:coordinate] + (point,) + best[coordinate + 1:] for point in points]))
+            newCandidates = [candidate for candidate in candidates if candidate not in evaluated]
+            if newCandidates:
+                evaluated.update(zip(newCandidates, evaluate_many(newCandidates)))
+            best = min(candidates, key=evaluated.get)
+        if best == previousBest:
+            break
+    return best, evaluated[best]
@@ -1,10 +1,13 @@
 import os
-from flask import Flask, request, render_template, redirect, Response
+from flask import Flask, request, render_template, redirect, Response, jsonify, abort
 from flask_classful import FlaskView, route
 import threading
 import pickle
+import json
+import time
 
-import traffic_env_optimising
+import traffic_demand
+import traffic_jobs
 import traffic_env_running
 
 CWD = os.path.dirname(os.path.realpath(__file__))
@@ -14,6 +17,81 @@ app = Flask(__name__)
 app.config.from_object(__name__)
 
 LIGHT_SENSOR_SENSITIVITY = 2
+# Worker processes shared by every job, how many jobs run at once and how many can wait.
+JOB_WORKERS = os.cpu_count() or 1
+JOB_CONCURRENCY = traffic_jobs.JOB_CONCURRENCY
+JOB_QUEUE_SIZE = traffic_jobs.JOB_QUEUE_SIZE
+# Least seconds between progress events of a job stream, replications finishing in between are sent together.
+JOB_EVENT_INTERVAL = 0.5
+# Seconds a job stream can be quiet before a comment is sent to keep the connection open.
+JOB_EVENT_KEEPALIVE = 15
+
+jobQueue = traffic_jobs.JobQueue(JOB_WORKERS, JOB_CONCURRENCY, JOB_QUEUE_SIZE)
+
+def requested_job(kinds=None):
+    # The job named by the request's job parameter, the latest finished one of kinds when there is none.
+    jobId = request.args.get('job')
+    if jobId is None:
+        return jobQueue.latest_job(kinds, 'finished')
+    job = jobQueue.get(jobId)
+    if job is None:
+        abort(404)
+    return job
+
+def job_results_url(job):
+    # Corridors have no results page, only their JSON results.
+    if job.kind in traffic_jobs.SITE_JOB_KINDS:
+        return '/get-timings/results?job=' + job.jobId
+    return '/jobs/' + job.jobId + '/results'
+
+def job_status(job):
+    return traffic_jobs.json_ready(dict(job.status_data(), queuePosition=jobQueue.queue_position(job), progress=job.progress.snapshot(),
+                                        summary=job.summary(), statusUrl='/jobs/' + job.jobId, eventsUrl='/jobs/' + job.jobId + '/events',
+                                        resultsUrl='/jobs/' + job.jobId + '/results'))
+
+def json_error(message, status):
+    return jsonify({'error': message}), status
+
+def job_scenario(scenario):
+    # (kind, envData, optData) of one scenario of a JSON submission, a plan when its optData asks for one.
+    if not isinstance(scenario, dict):
+        raise ValueError("Each scenario has to be an object with envData and optData")
+    optData = scenario.get('optData')
+    kind = scenario.get('kind', 'plan' if isinstance(optData, dict) and optData.get('plan', False) else 'optimisation')
+    return kind, scenario.get('envData'), optData
+
+def server_sent_event(event, data):
+    return 'event: ' + event + '\ndata: ' + json.dumps(data) + '\n\n'
+
+def job_events(job):
+    # Progress of the job whenever it changes, then its summary once it has finished or failed.
+    version = None
+    while True:
+        newVersion = job.progress.wait(version, JOB_EVENT_KEEPALIVE)
+        if job.status == 'finished':
+            yield server_sent_event('progress', job_status(job))
+            yield server_sent_event('finished', {'jobId': job.jobId, 'summary': job.summary(), 'resultsUrl': job_results_url(job)})
+            return
+        if job.status == 'failed':
+            yield server_sent_event('failed', {'jobId': job.jobId, 'error': job.error})
+            return
+        if newVersion == version and job.status == 'running':
+            yield ': keepalive\n\n'
+        else:
+            # A queued job moves up the queue without its own progress changing.
+            version = newVersion
+            yield server_sent_event('progress', job_status(job))
+            time.sleep(JOB_EVENT_INTERVAL)
+
+def load_results(job):
+    # Results of a finished job, or those the last optimisation before the job queue left behind.
+    if job is not None:
+        return job.results()
+    legacyPath = os.path.join(CWD, 'TempData', 'optimisationResults.pkl')
+    if not os.path.exists(legacyPath):
+        abort(404)
+    with open(legacyPath, 'rb') as tempData:
+        return pickle.load(tempData)
 
 class HomeView(FlaskView):
     route_base='/home'
@@ -44,64 +122,187 @@ class GetTimingsView(FlaskView):
         else:
             self.light2SensorSensitivity = -1
 
+        try:
+            self.light1Profile = traffic_demand.parse_profile(request.form.get("profile1", ""))
+            self.light2Profile = traffic_demand.parse_profile(request.form.get("profile2", ""))
+        except ValueError as error:
+            return Response(str(error), status=400)
+
         self.envTime = float(request.form["envTime"])
         self.greenTimeRange = [float(request.form.getlist('greenTimeRange')[0]), float(request.form.getlist('greenTimeRange')[1])]
         self.greenTimeStep = float(request.form["greenTimeStep"])
         self.iterations = int(request.form['iterationsRange'])
+        self.engine = request.form.get('engine', 'salabim')
+        self.prescreen = "prescreenCheck" in request.form
+        self.adaptive = "adaptiveCheck" in request.form
+        self.search = request.form.get('search', 'grid')
+        self.warmup = "warmupCheck" in request.form
+        self.estimator = request.form.get('estimator', 'replications')
+        self.objective = request.form.get('objective', 'mean')
+        self.cache = "cacheCheck" in request.form
+        if request.form.get('seed'):
+            try:
+                self.seed = int(request.form['seed'])
+            except ValueError:
+                return Response("The random seed has to be a whole number, got: " + request.form['seed'], status=400)
+        else:
+            self.seed = None
+        self.plan = "planCheck" in request.form
 
         self.environmentData = {'lightDistance':self.lightDistance,
                                 'speed':self.speed,
                                 'timeUpQueue':self.timeUpQueue,
                                 'lightData':[{'busyness':self.light1Busyness,
-                                                'sensorSensitivity':self.light1SensorSensitivity},
+                                                'sensorSensitivity':self.light1SensorSensitivity,
+                                                'demandProfile':self.light1Profile},
                                                 {'busyness':self.light2Busyness,
-                                                'sensorSensitivity':self.light2SensorSensitivity}]}
+                                                'sensorSensitivity':self.light2SensorSensitivity,
+                                                'demandProfile':self.light2Profile}]}
         self.optimisationData = {'envTime':self.envTime,
                                 'lightGreenTimeRange':self.greenTimeRange,
                                 'lightGreenTimeStep':self.greenTimeStep,
-                                'iterationsPerSetting':self.iterations}
+                                'iterationsPerSetting':self.iterations,
+                                'engine':self.engine,
+                                'prescreen':self.prescreen,
+                                'adaptive':self.adaptive,
+                                'search':self.search,
+                                'warmup':self.warmup,
+                                'estimator':self.estimator,
+                                'objective':self.objective,
+                                'cache':self.cache,
+                                'seed':self.seed,
+                                'plan':self.plan}
 
-        self.simulationThread = OptimisationThread(self.environmentData, self.optimisationData)
-        self.simulationThread.name = "optThread"
-        self.simulationThread.start()
-        return redirect("/get-timings/optimisation-running")
+        kind = 'plan' if self.plan else 'optimisation'
+        try:
+            job = jobQueue.submit(kind, self.environmentData, self.optimisationData)
+        except ValueError as error:
+            return Response(str(error), status=400)
+        except traffic_jobs.JobQueueFull as error:
+            return Response(str(error), status=503)
+        return redirect("/get-timings/optimisation-running?job=" + job.jobId)
 
     @route('/optimisation-running')
     def running_optimisation(self):
-        activeThreadNames = list(thread.name for thread in threading.enumerate())
-        if "optThread" in activeThreadNames:
-            simThread = threading.enumerate()[activeThreadNames.index("optThread")]
-            return render_template('optimisation-running.html', envData = simThread.envData, optData = simThread.optData)
-        else:
-            return redirect('/get-timings/results')
+        job = jobQueue.get(request.args.get('job', ''))
+        if job is None:
+            abort(404)
+        if job.status == 'finished':
+            return redirect(job_results_url(job))
+        return render_template('optimisation-running.html', envData = job.envData, optData = job.optData, progress = job.progress.snapshot(),
+                               job = job, queuePosition = jobQueue.queue_position(job))
     
     @route('/results')
     def finished_optimising(self):
-        with open(os.path.join(CWD, 'TempData', 'optimisationResults.pkl'), 'rb') as tempData:
-            optResults = pickle.load(tempData)
+        job = requested_job(traffic_jobs.SITE_JOB_KINDS)
+        if job is not None and job.kind not in traffic_jobs.SITE_JOB_KINDS:
+            return redirect(job_results_url(job))
+        optResults = load_results(job)
+        if optResults is None:
+            return redirect('/get-timings/optimisation-running?job=' + job.jobId)
+        jobId = job.jobId if job is not None else None
+        if 'plan' in optResults:
+            return render_template('plan-results.html', plan = optResults['plan'], graphName = optResults['graphFileName'],
+                                   periodCount = optResults['periodCount'], demandCount = optResults['demandCount'], jobId = jobId)
         bestLightGreenTime = optResults['optimalGreenTime']
         lowestWaitingTime = optResults['averageWaitingTime']
         graphFileName = optResults['graphFileName']
-        return render_template('optimisation-results.html', bestTiming = str(bestLightGreenTime), leastWaitingTime = str(round(lowestWaitingTime, 1)), graphName = graphFileName)
+        searchTrace = optResults.get('searchTrace')
+        # Waiting time summary of each light at the best green time.
+        optimalDistribution = None
+        for lightGreenTime, lightSummaries in optResults.get('distributions', []):
+            if lightGreenTime == bestLightGreenTime:
+                optimalDistribution = lightSummaries
+        if isinstance(bestLightGreenTime, list):
+            # A green split, one green time per phase.
+            bestTiming = ', '.join(str(phaseGreenTime) for phaseGreenTime in bestLightGreenTime)
+        else:
+            bestTiming = str(bestLightGreenTime)
+        return render_template('optimisation-results.html', bestTiming = bestTiming, leastWaitingTime = str(round(lowestWaitingTime, 1)), graphName = graphFileName, searchTrace = searchTrace,
+                               objective = optResults.get('objective'), objectiveValue = optResults.get('objectiveValue'), optimalDistribution = optimalDistribution,
+                               oversaturatedGreenTimes = optResults.get('oversaturatedGreenTimes', []), optimalOversaturated = optResults.get('optimalOversaturated', False),
+                               jobId = jobId)
 
 class SimulationView(FlaskView):
     route_base='/use-timings'
 
     @route('/simulation', methods=['POST','GET'])
     def index(self):
-        with open(os.path.join(CWD, 'TempData', 'optimisationResults.pkl'), 'rb') as tempData:
-            optResults = pickle.load(tempData)
+        job = requested_job(['optimisation'])
+        if job is not None and job.kind != 'optimisation':
+            return Response("Only the timings of a single site optimisation can be simulated", status=400)
+        optResults = load_results(job)
+        if optResults is None:
+            abort(409)
+        if 'optimalGreenTime' not in optResults:
+            return Response("Only the timings of a single site optimisation can be simulated", status=400)
         self.simThread = SimulationThread(optResults)
         self.simThread.start()
         return render_template('simulation.html')
 
-class OptimisationThread(threading.Thread):
-    def __init__(self, envData, optData):
-        threading.Thread.__init__(self)
-        self.envData = envData
-        self.optData = optData
-    def run(self):
-        traffic_env_optimising.run_optimisation(self.envData, self.optData)
+class JobsView(FlaskView):
+    route_base='/jobs'
+
+    def index(self):
+        jobs = [job for job in jobQueue.all_jobs()
+                if request.args.get('kind', job.kind) == job.kind and request.args.get('status', job.status) == job.status]
+        return jsonify([dict(job.status_data(), queuePosition=jobQueue.queue_position(job)) for job in jobs])
+
+    @route('/', methods=['POST'])
+    def submit(self):
+        """Queue one {kind, envData, optData} scenario, or a list of them, answering with their statuses straight away.
+
+        A list can hold up to traffic_jobs.JOB_BATCH_SIZE scenarios. When the queue cannot take them
+        all, those that fit are queued and each of the rest is answered with its
+        scenario number and an error, to be submitted again after Retry-After seconds.
+        """
+        submission = request.get_json(silent=True)
+        if submission is None:
+            return json_error("Submissions have to be JSON", 400)
+        batch = isinstance(submission, list)
+        scenarios = submission if batch else [submission]
+        if not scenarios:
+            return json_error("There are no scenarios to submit", 400)
+        try:
+            jobs = jobQueue.submit_many([job_scenario(scenario) for scenario in scenarios], partial=batch)
+        except ValueError as error:
+            return json_error(str(error), 400)
+        except traffic_jobs.JobQueueFull as error:
+            response, status = json_error(str(error), 503)
+            response.headers['Retry-After'] = str(JOB_EVENT_KEEPALIVE)
+            return response, status
+        if batch:
+            statuses = [job_status(job) for job in jobs]
+            statuses += [{'scenario': scenarioNum, 'error': "The job queue is full, submit this scenario again later"}
+                         for scenarioNum in range(len(jobs), len(scenarios))]
+            headers = {'Retry-After': str(JOB_EVENT_KEEPALIVE)} if len(jobs) < len(scenarios) else {}
+            return jsonify(statuses), 202, headers
+        return jsonify(job_status(jobs[0])), 202, {'Location': '/jobs/' + jobs[0].jobId}
+
+    @route('/<jobId>')
+    def status(self, jobId):
+        job = jobQueue.get(jobId)
+        if job is None:
+            abort(404)
+        return jsonify(job_status(job))
+
+    @route('/<jobId>/results')
+    def results(self, jobId):
+        job = jobQueue.get(jobId)
+        if job is None:
+            abort(404)
+        if job.status == 'failed':
+            return json_error(job.error, 409)
+        if job.status != 'finished':
+            return json_error("The job is still " + job.status, 409)
+        return jsonify(traffic_jobs.json_ready(job.results()))
+
+    @route('/<jobId>/events')
+    def events(self, jobId):
+        job = jobQueue.get(jobId)
+        if job is None:
+            abort(404)
+        return Response(job_events(job), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
 
 class SimulationThread(threading.Thread):
     def __init__(self, resData):
@@ -114,6 +315,7 @@ class SimulationThread(threading.Thread):
 HomeView.register(app)
 GetTimingsView.register(app)
 SimulationView.register(app)
+JobsView.register(app)
 
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=80, debug=debug)
@@ -0,0 +1,78 @@
+"""Pre-generated vehicle arrivals.
+
+Each light has a busyness chance of a vehicle arriving every second, so the
+gaps between arrivals are geometric. The gaps are drawn from NumPy a block at a
+time and the engines only wake up when a vehicle actually arrives. A light's
+arrivals depend only on its seed, so the same arrivals are replayed exactly for
+every green time and by every engine.
+
+Author: Edward Upton (engiego)
+        Ben Dodd (mitgobla)
+"""
+
+import math
+
+import numpy as np
+
+# Gaps drawn from the generator at a time.
+ARRIVAL_BLOCK_SIZE = 1024
+
+
+def arrival_rng(lightSeed=None):
+    return np.random.default_rng(lightSeed)
+
+
+def arrival_blocks(busyness, rng, blockSize=ARRIVAL_BLOCK_SIZE):
+    """Arrival times of one light, blockSize at a time, as whole seconds from 0."""
+    if busyness <= 0:
+        return
+    probability = min(busyness, 1.0)
+    lastArrival = -1
+    while True:
+        arrivals = lastArrival + np.cumsum(rng.geometric(probability, blockSize))
+        lastArrival = int(arrivals[-1])
+        yield arrivals.astype(float)
+
+
+def arrival_times(busyness, envTime, rng, blockSize=ARRIVAL_BLOCK_SIZE):
+    """Every arrival time of one light before envTime."""
+    blocks = []
+    for block in arrival_blocks(busyness, rng, blockSize):
+        blocks.append(block)
+        if block[-1] >= envTime:
+            break
+    if not blocks:
+        return np.empty(0)
+    arrivals = np.concatenate(blocks)
+    return arrivals[arrivals < envTime]
+
+
+class ArrivalStream():
+    """The arrivals of one light read one at a time, nextArrival is inf once there are none."""
+    __slots__ = ('blocks', 'block', 'index', 'nextArrival')
+
+    def __init__(self, busyness, rng, blockSize=ARRIVAL_BLOCK_SIZE):
+        self.blocks = arrival_blocks(busyness, rng, blockSize)
+        self.block = []
+        self.index = 0
+        self.nextArrival = math.inf
+        self.advance()
+
+    def advance(self):
+        if self.index >= len(self.block):
+            block = next(self.blocks, None)
+            if block is None:
+                self.nextArrival = math.inf
+                return
+            # Plain floats are much quicker to read one at a time than NumPy scalars.
+            self.block = block.tolist()
+            self.index = 0
+        self.nextArrival = self.block[self.index]
+        self.index += 1
+
+
+def arrival_streams(envData, lightSeeds=None):
+    """An ArrivalStream for every light, seeded by lightSeeds when given."""
+    if lightSeeds is None:
+        lightSeeds = [None] * len(envData['lightData'])
+    return [ArrivalStream(lightData['busyness'], arrival_rng(lightSeed)) for lightData, lightSeed in zip(envData['lightData'], lightSeeds)]
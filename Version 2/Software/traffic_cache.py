@@ -0,0 +1,85 @@
+"""Content addressed cache of simulation results on disk.
+
+Each result is pickled to a file named by the hash of everything that decides
+it, so an identical seeded replication never has to be simulated twice. The
+modification time of a file is its last use and the least recently used files
+are removed once the cache is over its size limit.
+
+Author: Edward Upton (engiego)
+        Ben Dodd (mitgobla)
+"""
+
+import hashlib
+import json
+import os
+import pickle
+import tempfile
+
+CWD = os.path.dirname(os.path.realpath(__file__))
+
+CACHE_DIRECTORY = os.path.join(CWD, 'TempData', 'resultCache')
+CACHE_MAX_BYTES = 50 * 1024 * 1024
+
+
+def result_key(**keyData):
+    """Hash of keyData written as canonical JSON, the same data always gives the same key."""
+    canonical = json.dumps(keyData, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+
+class ResultCache():
+
+    def __init__(self, directory=CACHE_DIRECTORY, maxBytes=CACHE_MAX_BYTES):
+        self.directory = directory
+        self.maxBytes = maxBytes
+        self.hits = 0
+        self.misses = 0
+
+    def path(self, key):
+        return os.path.join(self.directory, key[:2], key + '.pkl')
+
+    def get(self, key, default=None):
+        path = self.path(key)
+        try:
+            with open(path, 'rb') as resultFile:
+                result = pickle.load(resultFile)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            self.misses += 1
+            return default
+        os.utime(path)
+        self.hits += 1
+        return result
+
+    def put(self, key, result):
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Written next to the final name first so a reader never sees half a file, under a
+        # name of its own so concurrent jobs putting the same key do not share a temporary file.
+        tempFile, tempPath = tempfile.mkstemp(suffix='.tmp', dir=os.path.dirname(path))
+        with os.fdopen(tempFile, 'wb') as resultFile:
+            pickle.dump(result, resultFile, pickle.HIGHEST_PROTOCOL)
+        os.replace(tempPath, path)
+
+    def evict(self):
+        """Remove the least recently used results until the cache fits in maxBytes."""
+        entries = []
+        for root, directories, fileNames in os.walk(self.directory):
+            for fileName in fileNames:
+                if fileName.endswith('.tmp'):
+                    # Another job's result still being written.
+                    continue
+                path = os.path.join(root, fileName)
+                try:
+                    fileStat = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((fileStat.st_mtime, fileStat.st_size, path))
+        totalBytes = sum(size for lastUsed, size, path in entries)
+        for lastUsed, size, path in sorted(entries):
+            if totalBytes <= self.maxBytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            totalBytes -= size
@@ -0,0 +1,207 @@
+"""Corridors of several roadworks sites along one road.
+
+The sites share one kernel, so a platoon let through at one site reaches the
+next site travelTime later and joins the back of its queue on top of that
+light's own arrivals. corridorData holds the 'sites', each an envData, and
+either the 'travelTimes' between neighbouring shuttles, light 0 of each site
+feeding light 0 of the next and light 1 feeding light 1 of the one before, or
+explicit 'links' of [[from site, from light], [to site, to light], travel time].
+
+Each site runs its cycle from an offset. The offset optimiser holds every
+site's green time and searches the offsets one site at a time, simulating all
+the candidate offsets of a site together on the worker processes.
+
+Author: Edward Upton (engiego)
+        Ben Dodd (mitgobla)
+"""
+
+import concurrent.futures
+import math
+import pickle
+
+import green_time_search
+import traffic_arrivals
+import traffic_cache
+import traffic_env_kernel
+import traffic_env_optimising
+import traffic_phases
+import traffic_saturation
+import traffic_stats
+
+# Seconds between the candidate offsets tried for a site.
+OFFSET_STEP = 2
+
+
+def corridor_links(corridorData):
+    """Every (from site, from light), (to site, to light), travel time of the corridor."""
+    sites = corridorData['sites']
+    links = corridorData.get('links')
+    if links is None:
+        travelTimes = corridorData['travelTimes']
+        if len(travelTimes) != len(sites) - 1:
+            raise ValueError("A corridor of " + str(len(sites)) + " sites needs " + str(len(sites) - 1) + " travel times")
+        links = []
+        for siteNum, travelTime in enumerate(travelTimes):
+            links.append([[siteNum, 0], [siteNum + 1, 0], travelTime])
+            links.append([[siteNum + 1, 1], [siteNum, 1], travelTime])
+    corridorLinks = []
+    for (fromSite, fromLight), (toSite, toLight), travelTime in links:
+        for siteNum, lightNum in [(fromSite, fromLight), (toSite, toLight)]:
+            if not (0 <= siteNum < len(sites) and 0 <= lightNum < len(sites[siteNum]['lightData'])):
+                raise ValueError("There is no light " + str(lightNum) + " at site " + str(siteNum))
+        if float(travelTime) < 0:
+            raise ValueError("Travel times between sites cannot be negative")
+        corridorLinks.append(((int(fromSite), int(fromLight)), (int(toSite), int(toLight)), float(travelTime)))
+    fromLights = [fromLight for fromLight, toLight, travelTime in corridorLinks]
+    if len(set(fromLights)) != len(fromLights):
+        raise ValueError("A light can only feed one other light")
+    return corridorLinks
+
+
+def corridor_light_count(corridorData):
+    return sum(len(siteData['lightData']) for siteData in corridorData['sites'])
+
+
+def run_corridor_replication(corridorData, siteGreenTimes, offsets, envTime, lightSeeds=None):
+    """Waiting time StreamingStats and maximum queue length of every light, site by site, and whether the corridor was oversaturated."""
+    kernel = traffic_env_kernel.Kernel()
+    siteEnvs = []
+    firstLightNum = 0
+    for siteData, siteGreenTime, offset in zip(corridorData['sites'], siteGreenTimes, offsets):
+        lightCount = len(siteData['lightData'])
+        siteSeeds = None if lightSeeds is None else lightSeeds[firstLightNum:firstLightNum + lightCount]
+        firstLightNum += lightCount
+        siteEnvs.append(traffic_env_kernel.TrafficEnvironment(kernel, siteData, siteGreenTime, traffic_arrivals.arrival_streams(siteData, siteSeeds), offset=offset))
+    for (fromSite, fromLight), (toSite, toLight), travelTime in corridor_links(corridorData):
+        siteEnvs[fromSite].lightList[fromLight].link = traffic_env_kernel.Link(kernel, siteEnvs[toSite].lightList[toLight], siteEnvs[toSite], travelTime)
+    lightList = [light for trafficEnv in siteEnvs for light in trafficEnv.lightList]
+    detector = traffic_saturation.SaturationDetector()
+    detector.advance(kernel.run, lambda: [light.residual_queue_length() for light in lightList], envTime)
+    oversaturated = detector.abortTime is not None
+    if oversaturated:
+        for light in lightList:
+            light.add_queued_waiting_times()
+    return [light.waitingTimeStats for light in lightList], [light.maxQueueLength for light in lightList], oversaturated
+
+
+def corridor_result_key(corridorData, optData, siteGreenTimes, offsets, iteration):
+    return traffic_cache.result_key(resultFormat=traffic_env_optimising.CACHE_RESULT_FORMAT, corridor=corridorData, envTime=int(optData['envTime']),
+                                    engine=traffic_env_optimising.engine_version('kernel'), seed=optData['seed'], iteration=iteration,
+                                    siteGreenTimes=[traffic_phases.green_time_value(siteGreenTime) for siteGreenTime in siteGreenTimes], offsets=list(offsets))
+
+
+def simulate_offsets(corridorData, optData, siteGreenTimes, offsetVectors, executor=None, cache=None, progress=None, distributions=None):
+    # Objective of every replication of each offset vector, replications of the same iteration see the same arrivals.
+    iterations = int(optData['iterationsPerSetting'])
+    envTime = int(optData['envTime'])
+    weights = traffic_stats.objective_weights(optData.get('objective', traffic_stats.OBJECTIVE))
+    lightCount = corridor_light_count(corridorData)
+    replications = [(offsets, iter) for offsets in offsetVectors for iter in range(iterations)]
+    if progress is not None:
+        progress.expect(len(replications))
+    results = {}
+    if cache is not None:
+        for offsets, iter in replications:
+            result = cache.get(corridor_result_key(corridorData, optData, siteGreenTimes, offsets, iter))
+            if result is not None:
+                results[(offsets, iter)] = result
+                if progress is not None:
+                    progress.replication_done(offsets, iter, traffic_stats.objective_value(result[0], weights), cached=True, oversaturated=result[2])
+    missing = [replication for replication in replications if replication not in results]
+
+    def replication_finished(replication, result):
+        results[replication] = result
+        if cache is not None:
+            cache.put(corridor_result_key(corridorData, optData, siteGreenTimes, *replication), result)
+        objectiveValue = traffic_stats.objective_value(result[0], weights)
+        print("Finished Offsets:", list(replication[0]), ", Iteration:", replication[1], ", Objective Waiting Time For Car:", objectiveValue)
+        if progress is not None:
+            progress.replication_done(replication[0], replication[1], objectiveValue, oversaturated=result[2])
+
+    if executor is None:
+        for offsets, iter in missing:
+            lightSeeds = traffic_env_optimising.replication_seeds(optData['seed'], iter, lightCount)
+            replication_finished((offsets, iter), run_corridor_replication(corridorData, siteGreenTimes, offsets, envTime, lightSeeds))
+    else:
+        futures = {executor.submit(run_corridor_replication, corridorData, siteGreenTimes, offsets, envTime,
+                                   traffic_env_optimising.replication_seeds(optData['seed'], iter, lightCount)): (offsets, iter) for offsets, iter in missing}
+        for future in concurrent.futures.as_completed(futures):
+            replication_finished(futures[future], future.result())
+
+    settingWaitingTimes = {offsets: [] for offsets in offsetVectors}
+    for offsets, iter in replications:
+        lightWaitingStats, lightMaxQueueLengths, oversaturated = results[(offsets, iter)]
+        settingWaitingTimes[offsets].append(traffic_stats.objective_value(lightWaitingStats, weights))
+        traffic_env_optimising.record_distribution(distributions, offsets, lightWaitingStats, lightMaxQueueLengths, oversaturated)
+    return settingWaitingTimes
+
+
+def run_corridor_optimisation(corridorData, optData, progress=None, executor=None, resultsPath=None):
+    """Find the offsets between the sites of a corridor with the least waiting, every site's green time held.
+
+    optData holds the 'siteGreenTimes', each a green time or green split, and the
+    usual envTime, iterationsPerSetting, objective, workers, seed and cache. The
+    first site's offset stays 0, the others are tried every offsetStep seconds
+    across their cycle. executor is as for run_optimisation, the results are only
+    pickled when there is a resultsPath.
+    """
+    optData = traffic_env_optimising.choose_seed(optData, required=True)
+    sites = corridorData['sites']
+    siteGreenTimes = [tuple(siteGreenTime) if isinstance(siteGreenTime, (list, tuple)) else float(siteGreenTime) for siteGreenTime in optData['siteGreenTimes']]
+    if len(siteGreenTimes) != len(sites):
+        raise ValueError("A corridor of " + str(len(sites)) + " sites needs " + str(len(sites)) + " green times")
+    corridor_links(corridorData)
+    offsetStep = float(optData.get('offsetStep', OFFSET_STEP))
+    cycleTimes = [traffic_phases.cycle_time(siteData, siteGreenTime) for siteData, siteGreenTime in zip(sites, siteGreenTimes)]
+    coordinatePoints = [[0.0]] + [[round(offsetNum * offsetStep, 2) for offsetNum in range(int(math.ceil(cycleTime / offsetStep)))] for cycleTime in cycleTimes[1:]]
+    envTime = int(optData['envTime'])
+
+    cache = None
+    if optData.get('cache', True):
+        cache = traffic_cache.ResultCache(maxBytes=int(optData.get('cacheMaxBytes', traffic_cache.CACHE_MAX_BYTES)))
+    workers = int(optData.get('workers', 1))
+    ownExecutor = executor is None and workers > 1
+    if ownExecutor:
+        executor = concurrent.futures.ProcessPoolExecutor(max_workers=workers)
+    settingWaitingTimes = {}
+    distributions = {}
+    offsetTrace = []
+
+    def evaluate_many(offsetVectors):
+        settingWaitingTimes.update(simulate_offsets(corridorData, optData, siteGreenTimes, offsetVectors, executor, cache, progress, distributions))
+        rankingValues = []
+        for offsets in offsetVectors:
+            averageWaitingTime = sum(settingWaitingTimes[offsets]) / len(settingWaitingTimes[offsets])
+            oversaturated = traffic_env_optimising.is_oversaturated(distributions, offsets)
+            offsetTrace.append([list(offsets), averageWaitingTime, oversaturated])
+            rankingValues.append(traffic_env_optimising.ranking_value(averageWaitingTime, oversaturated, envTime))
+        return rankingValues
+
+    try:
+        startOffsets = (0.0,) * len(sites)
+        bestOffsets, bestValue = green_time_search.coordinate_search(evaluate_many, startOffsets, coordinatePoints,
+                                                                     int(optData.get('offsetPasses', green_time_search.COORDINATE_PASSES)))
+    finally:
+        if ownExecutor:
+            executor.shutdown()
+        if cache is not None:
+            cache.evict()
+            print("Result cache hits:", cache.hits, ", misses:", cache.misses)
+
+    optimalLightWaitingStats = distributions[bestOffsets]['lightWaitingStats']
+    results = {}
+    results['optimalOffsets'] = list(bestOffsets)
+    results['objectiveValue'] = sum(settingWaitingTimes[bestOffsets]) / len(settingWaitingTimes[bestOffsets])
+    results['averageWaitingTime'] = float(traffic_stats.objective_value(optimalLightWaitingStats, {'mean': 1.0}))
+    results['optimalOversaturated'] = traffic_env_optimising.is_oversaturated(distributions, bestOffsets)
+    # Every site starting its cycle together, what the offsets are an improvement on.
+    results['unoffsetObjectiveValue'] = sum(settingWaitingTimes[startOffsets]) / len(settingWaitingTimes[startOffsets])
+    results['lightSummaries'] = [waitingTimeStats.summary() for waitingTimeStats in optimalLightWaitingStats]
+    results['siteGreenTimes'] = [traffic_phases.green_time_value(siteGreenTime) for siteGreenTime in siteGreenTimes]
+    results['siteCycleTimes'] = cycleTimes
+    results['offsetTrace'] = offsetTrace
+    results['seed'] = optData['seed']
+    if resultsPath is not None:
+        with open(resultsPath, 'wb+') as resultsFile:
+            pickle.dump(results, resultsFile, pickle.HIGHEST_PROTOCOL)
+    return results
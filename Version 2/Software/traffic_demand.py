@@ -0,0 +1,72 @@
+"""Time of day demand profiles.
+
+A light's busyness can change over the day. Its demandProfile is a list of
+[start hour, busyness] pairs, each busyness holding from its start hour until
+the next one, and the last wrapping round past midnight to the first. A light
+without a profile keeps its busyness all day.
+
+Author: Edward Upton (engiego)
+        Ben Dodd (mitgobla)
+"""
+
+HOURS_IN_DAY = 24
+
+
+def light_profile(lightData):
+    """The light's demand profile sorted by start hour, a constant one when it has none."""
+    profile = lightData.get('demandProfile')
+    if not profile:
+        return [[0.0, float(lightData['busyness'])]]
+    profile = sorted([float(startHour), float(busyness)] for startHour, busyness in profile)
+    for startHour, busyness in profile:
+        if not 0 <= startHour < HOURS_IN_DAY:
+            raise ValueError("Demand profile hours must be from 0 up to 24: " + str(startHour))
+        if not 0 <= busyness <= 1:
+            raise ValueError("Demand profile busyness must be from 0 to 1: " + str(busyness))
+    return profile
+
+
+def busyness_at(profile, hour):
+    """Busyness of a sorted profile at hour, before the first start hour it is still the last one's."""
+    busyness = profile[-1][1]
+    for startHour, startBusyness in profile:
+        if startHour > hour:
+            break
+        busyness = startBusyness
+    return busyness
+
+
+def demand_periods(envData):
+    """Split the day into (start hour, end hour, [busyness of each light]) periods.
+
+    A new period starts whenever any light's busyness changes, neighbouring
+    periods with the same demand are joined back together.
+    """
+    profiles = [light_profile(lightData) for lightData in envData['lightData']]
+    changes = sorted({0.0} | {startHour for profile in profiles for startHour, busyness in profile})
+    periods = []
+    for start, end in zip(changes, changes[1:] + [float(HOURS_IN_DAY)]):
+        busyness = [busyness_at(profile, start) for profile in profiles]
+        if periods and periods[-1][2] == busyness:
+            periods[-1] = (periods[-1][0], end, busyness)
+        else:
+            periods.append((start, end, busyness))
+    return periods
+
+
+def round_demand(busyness, resolution):
+    """Busyness of each light rounded to resolution, so periods with nearly the same demand are simulated once."""
+    return tuple(round(round(lightBusyness / resolution) * resolution, 10) for lightBusyness in busyness)
+
+
+def parse_profile(text):
+    """Read a profile written as "hour:busyness, hour:busyness", None when text is blank."""
+    if not text.strip():
+        return None
+    profile = []
+    for entry in text.split(','):
+        startHour, separator, busyness = entry.partition(':')
+        if not separator:
+            raise ValueError("Demand profile entries are written hour:busyness, got: " + entry.strip())
+        profile.append([float(startHour), float(busyness)])
+    return light_profile({'demandProfile': profile})
@@ -0,0 +1,233 @@
+"""Vectorised batch engine for the two light shuttle.
+
+Runs many replications of the traffic environment at once as NumPy arrays
+instead of one salabim environment per replication. Every row of the batch is
+an independent replication with its own light green time, so a whole sweep of
+settings can be simulated together.
+
+Author: Edward Upton (engiego)
+        Ben Dodd (mitgobla)
+"""
+
+import numpy as np
+
+import traffic_arrivals
+import traffic_phases
+import traffic_saturation
+import traffic_stats
+
+# Rows simulated together, keeps the arrival arrays to a sensible size.
+BATCH_CHUNK_SIZE = 256
+# Bumped whenever a change to the model would change seeded results, old cached results are then ignored.
+ENGINE_VERSION = 2
+
+
+def generate_arrivals(rng, busyness, envTime, batchSize, lightSeeds=None):
+    # The same arrivals as traffic_arrivals gives VehicleSpawner, rows sharing a seed share their arrivals.
+    if lightSeeds is None:
+        lightSeeds = [None] * batchSize
+    seededArrivals = {}
+    rowArrivals = []
+    for lightSeed in lightSeeds:
+        if lightSeed is None:
+            rowArrivals.append(traffic_arrivals.arrival_times(busyness, envTime, rng))
+            continue
+        if lightSeed not in seededArrivals:
+            seededArrivals[lightSeed] = traffic_arrivals.arrival_times(busyness, envTime, traffic_arrivals.arrival_rng(lightSeed))
+        rowArrivals.append(seededArrivals[lightSeed])
+    width = max((len(arrivals) for arrivals in rowArrivals), default=0)
+    # Always keep one column of inf so there is never a missing next vehicle.
+    arrivals = np.full((batchSize, width + 1), np.inf)
+    for row, rowArrival in enumerate(rowArrivals):
+        arrivals[row, :len(rowArrival)] = rowArrival
+    return arrivals
+
+
+class LightBatch():
+
+    def __init__(self, arrivals, sensitivity, timeUpQueue):
+        batchSize = arrivals.shape[0]
+        self.arrivals = arrivals
+        self.sensitivity = sensitivity
+        self.timeUpQueue = timeUpQueue
+        self.nextVehicle = np.zeros(batchSize, dtype=int)
+        self.lastDeparture = np.zeros(batchSize)
+        self.lastMovedUp = np.full(batchSize, -np.inf)
+        # Every vehicle's departure, inf until it has gone.
+        self.departures = np.full(arrivals.shape, np.inf)
+        # Where each row stopped and whether it was aborted as oversaturated.
+        self.endTime = np.full(batchSize, np.inf)
+        self.oversaturated = np.zeros(batchSize, dtype=bool)
+
+    def queue_lengths(self, times):
+        # Vehicles arrived before each row's time less those departed before it.
+        return (self.arrivals < times[:, None]).sum(axis=1) - (self.departures < times[:, None]).sum(axis=1)
+
+    def residual_queue_lengths(self, windowStart, windowEnd, rows):
+        # Shortest each checked row's queue has been in its window, the queue is shortest just after a departure.
+        residualQueueLengths = self.queue_lengths(windowStart)
+        for row in np.flatnonzero(rows):
+            departures = self.departures[row]
+            departed = np.flatnonzero((departures >= windowStart[row]) & (departures < windowEnd[row]))
+            if len(departed):
+                queueLengths = np.searchsorted(self.arrivals[row], departures[departed], side='right') - departed - 1
+                residualQueueLengths[row] = min(residualQueueLengths[row], queueLengths.min())
+        return residualQueueLengths
+
+    def censor(self, endTime, oversaturated):
+        # An aborted row has already been served past its end, those departures never happened in the other engines.
+        self.departures[self.departures >= endTime[:, None]] = np.inf
+        self.endTime = endTime
+        self.oversaturated = oversaturated
+
+    def waiting_times(self):
+        # Waiting time of every vehicle that counts, nan for the rest. Vehicles still queued
+        # when an oversaturated row was aborted count with the time they had waited so far.
+        departed = np.isfinite(self.departures)
+        queued = ~departed & self.oversaturated[:, None] & (self.arrivals < self.endTime[:, None])
+        return np.where(departed, self.departures, np.where(queued, self.endTime[:, None], np.nan)) - self.arrivals
+
+    def mean_waiting_time(self):
+        waitingTimes = self.waiting_times()
+        counted = ~np.isnan(waitingTimes)
+        with np.errstate(invalid='ignore'):
+            return np.where(counted, waitingTimes, 0).sum(axis=1) / counted.sum(axis=1)
+
+    def waiting_time_stats(self):
+        # One StreamingStats per row.
+        waitingTimes = self.waiting_times()
+        return [traffic_stats.StreamingStats.from_values(rowWaitingTimes[~np.isnan(rowWaitingTimes)]) for rowWaitingTimes in waitingTimes]
+
+    def max_queue_lengths(self):
+        # Vehicles leave in order, so the queue just after vehicle k arrives is k + 1 less those departed before it.
+        maxQueueLengths = []
+        for arrivals, departures, endTime in zip(self.arrivals, self.departures, self.endTime):
+            arrived = arrivals[arrivals < endTime]
+            if len(arrived) == 0:
+                maxQueueLengths.append(0)
+                continue
+            queueLengths = np.arange(1, len(arrived) + 1) - np.searchsorted(departures[:len(arrived)], arrived, side='left')
+            maxQueueLengths.append(int(queueLengths.max()))
+        return maxQueueLengths
+
+
+def serve_green(light, greenStart, greenLimit, active, envTime):
+    arrivals, nextVehicle, lastDeparture, lastMovedUp = light.arrivals, light.nextVehicle, light.lastDeparture, light.lastMovedUp
+    rows = np.arange(len(greenStart))
+    greenEnd = greenLimit.copy()
+    serving = active.copy()
+    while serving.any():
+        head = arrivals[rows, nextVehicle]
+        queued = head < lastDeparture
+        # A queued vehicle moves up once the vehicle in front moves. If that vehicle
+        # moved up but then had to wait for green, it has to move up a second time.
+        followedUp = lastMovedUp + light.timeUpQueue + traffic_phases.MOVED_PULSE_TIME
+        afterDeparture = lastDeparture + light.timeUpQueue + traffic_phases.MOVED_PULSE_TIME
+        caughtUp = (lastMovedUp >= head) & (lastDeparture <= followedUp)
+        ready = np.where(queued, np.where(caughtUp, followedUp, afterDeparture), head)
+        departure = np.maximum(ready, greenStart)
+
+        # The movement sensor ends the green once the queue has been empty for its sensitivity.
+        sensorCut = np.maximum(lastDeparture + light.sensitivity, greenStart)
+        cut = serving & ~queued & (sensorCut <= head) & (sensorCut < greenLimit)
+        greenEnd[cut] = sensorCut[cut]
+        serving &= ~cut
+
+        moving = serving & (departure < greenLimit) & (departure < envTime)
+        lastDeparture[moving] = departure[moving]
+        light.departures[rows[moving], nextVehicle[moving]] = departure[moving]
+        light.lastMovedUp[moving] = np.where(queued, ready - traffic_phases.MOVED_PULSE_TIME, -np.inf)[moving]
+        nextVehicle[moving] += 1
+        serving &= moving
+    return greenEnd
+
+
+def phase_green_times(greenTimes, phaseCount):
+    # One column per phase, a row of single green times is shared by every phase.
+    greenTimes = np.asarray(greenTimes, dtype=float)
+    if greenTimes.ndim == 1:
+        return np.repeat(greenTimes[:, None], phaseCount, axis=1)
+    if greenTimes.shape[1] != phaseCount:
+        raise ValueError("A green split needs one green time for each of the " + str(phaseCount) + " phases")
+    return greenTimes
+
+
+def validate_site(envData):
+    """Raises ValueError for a site the batch engine cannot simulate."""
+    for phase in traffic_phases.site_phases(envData):
+        # Each light is served on its own, so a phase cannot wait for several sensors at once.
+        if len(phase) > 1 and any(envData['lightData'][lightNum]['sensorSensitivity'] != -1 for lightNum in phase):
+            raise ValueError("The batch engine cannot run sensors on approaches that share a phase")
+
+
+def simulate_batch(envData, greenTimes, envTime, rng, lightSeeds=None):
+    validate_site(envData)
+    phases = traffic_phases.site_phases(envData)
+    phaseClearanceTimes = traffic_phases.phase_clearance_times(envData, phases)
+    greenTimes = phase_green_times(greenTimes, len(phases))
+    batchSize = len(greenTimes)
+    timeUpQueue = envData['timeUpQueue']
+
+    lightList = []
+    for lightNum, lightData in enumerate(envData['lightData']):
+        sensitivity = np.inf if lightData['sensorSensitivity'] == -1 else float(lightData['sensorSensitivity'])
+        arrivals = generate_arrivals(rng, lightData['busyness'], envTime, batchSize, None if lightSeeds is None else [int(seeds[lightNum]) for seeds in lightSeeds])
+        lightList.append(LightBatch(arrivals, sensitivity, timeUpQueue))
+
+    # Same cycle as TrafficManagement, every row advanced one phase at a time.
+    clock = np.zeros(batchSize)
+    endTime = np.full(batchSize, float(envTime))
+    oversaturated = np.zeros(batchSize, dtype=bool)
+    detector = traffic_saturation.SaturationDetector()
+    nextCheck = np.full(batchSize, float(detector.interval))
+    while (clock < endTime).any():
+        for phaseNum, phase in enumerate(phases):
+            active = clock < endTime
+            greenStart = clock + phaseClearanceTimes[phaseNum] + traffic_phases.AMBER_TIME
+            greenEnd = np.max([serve_green(lightList[lightNum], greenStart, greenStart + greenTimes[:, phaseNum], active, endTime) for lightNum in phase], axis=0)
+            clock = np.where(active, greenEnd + traffic_phases.AMBER_TIME, clock)
+        # A row's queues are checked once its clock has passed the check time, every departure before it is known by then.
+        checking = (clock >= nextCheck) & (nextCheck < endTime)
+        while checking.any():
+            residualQueueLengths = np.stack([light.residual_queue_lengths(nextCheck - detector.interval, nextCheck, checking) for light in lightList], axis=1)
+            aborted = detector.check(residualQueueLengths, checking)
+            endTime = np.where(aborted, nextCheck, endTime)
+            oversaturated |= aborted
+            nextCheck = np.where(checking, nextCheck + detector.interval, nextCheck)
+            checking = (clock >= nextCheck) & (nextCheck < endTime)
+
+    for light in lightList:
+        light.censor(endTime, oversaturated)
+    return lightList
+
+
+def run_batch(envData, greenTimes, envTime, lightSeeds=None):
+    """Mean waiting time of each light for one replication per green time.
+
+    A green time can also be a green split with one time per phase. lightSeeds
+    optionally gives the seed of each light for every row.
+    """
+    rng = np.random.default_rng()
+    greenTimes = [traffic_phases.green_time_value(greenTime) for greenTime in greenTimes]
+    results = []
+    for start in range(0, len(greenTimes), BATCH_CHUNK_SIZE):
+        chunkSeeds = None if lightSeeds is None else lightSeeds[start:start + BATCH_CHUNK_SIZE]
+        lightList = simulate_batch(envData, greenTimes[start:start + BATCH_CHUNK_SIZE], envTime, rng, chunkSeeds)
+        results.append(np.stack([light.mean_waiting_time() for light in lightList], axis=1))
+    if not results:
+        return np.empty((0, len(envData['lightData'])))
+    return np.concatenate(results)
+
+
+def run_batch_distributions(envData, greenTimes, envTime, lightSeeds=None):
+    """Waiting time StreamingStats, maximum queue length of each light and whether it was oversaturated for one replication per green time."""
+    rng = np.random.default_rng()
+    greenTimes = [traffic_phases.green_time_value(greenTime) for greenTime in greenTimes]
+    results = []
+    for start in range(0, len(greenTimes), BATCH_CHUNK_SIZE):
+        chunkSeeds = None if lightSeeds is None else lightSeeds[start:start + BATCH_CHUNK_SIZE]
+        lightList = simulate_batch(envData, greenTimes[start:start + BATCH_CHUNK_SIZE], envTime, rng, chunkSeeds)
+        lightWaitingStats = [light.waiting_time_stats() for light in lightList]
+        lightMaxQueueLengths = [light.max_queue_lengths() for light in lightList]
+        results.extend(zip(zip(*lightWaitingStats), zip(*lightMaxQueueLengths), lightList[0].oversaturated.tolist()))
+    return [(list(waitingStats), list(maxQueueLengths), oversaturated) for waitingStats, maxQueueLengths, oversaturated in results]
@@ -0,0 +1,361 @@
+"""Lightweight discrete event kernel for the headless optimiser.
+
+Runs the same traffic logic as traffic_env_optimising without salabim. Events
+are plain callbacks kept on a binary heap and the entities use __slots__, so
+there are no names, monitors or animation objects to build for every vehicle.
+
+Author: Edward Upton (engiego)
+        Ben Dodd (mitgobla)
+"""
+
+import heapq
+import math
+
+import traffic_arrivals
+import traffic_phases
+import traffic_saturation
+import traffic_stats
+import traffic_warmup
+
+# Bumped whenever a change to the model would change seeded results, old cached results are then ignored.
+ENGINE_VERSION = 2
+
+
+class Kernel():
+    __slots__ = ('now', 'eventList', 'eventCount')
+
+    def __init__(self):
+        self.now = 0
+        self.eventList = []
+        self.eventCount = 0
+
+    def schedule(self, delay, callback):
+        # Events are lists so they can be cancelled in place, the count keeps same time events in order.
+        event = [self.now + delay, self.eventCount, callback]
+        self.eventCount += 1
+        heapq.heappush(self.eventList, event)
+        return event
+
+    def cancel(self, event):
+        if event is not None:
+            event[2] = None
+
+    def run(self, till):
+        eventList = self.eventList
+        heappop = heapq.heappop
+        while eventList and eventList[0][0] < till:
+            eventTime, _, callback = heappop(eventList)
+            if callback is not None:
+                self.now = eventTime
+                callback()
+        self.now = till
+
+
+class VehicleSpawner():
+    __slots__ = ('kernel', 'trafficEnv', 'lightList', 'arrivalStreams', 'queueObservations')
+
+    def __init__(self, kernel, trafficEnv, arrivalStreams, queueObservations=None):
+        self.kernel = kernel
+        self.trafficEnv = trafficEnv
+        self.lightList = trafficEnv.lightList
+        self.arrivalStreams = arrivalStreams
+        self.queueObservations = queueObservations
+        kernel.schedule(0, self.tick)
+
+    def tick(self):
+        now = self.kernel.now
+        if self.queueObservations is not None:
+            self.queueObservations.append(sum(light.queueLength for light in self.lightList))
+        for light, arrivalStream in zip(self.lightList, self.arrivalStreams):
+            if arrivalStream.nextArrival <= now:
+                arrivalStream.advance()
+                Vehicle(self.kernel, light, self.trafficEnv)
+        if self.queueObservations is not None:
+            # The queue is still sampled every second for the warm-up detection.
+            self.kernel.schedule(1, self.tick)
+            return
+        nextArrival = min(arrivalStream.nextArrival for arrivalStream in self.arrivalStreams)
+        if nextArrival == now + 1:
+            self.kernel.schedule(1, self.tick)
+        elif nextArrival != math.inf:
+            # Woken a second early so the arrival is queued against other events due
+            # at the same time just as it was when the spawner ticked every second.
+            self.kernel.schedule(nextArrival - 1 - now, self.wake)
+
+    def wake(self):
+        self.kernel.schedule(1, self.tick)
+
+
+class TrafficManagement():
+    __slots__ = ('kernel', 'phaseLights', 'phaseGreenTimes', 'phaseClearanceTimes', 'phaseNum', 'greenTimeout')
+
+    def __init__(self, kernel, trafficEnv, offset=0):
+        self.kernel = kernel
+        self.phaseLights = [[trafficEnv.lightList[lightNum] for lightNum in phase] for phase in trafficEnv.phases]
+        self.phaseGreenTimes = trafficEnv.phaseGreenTimes
+        self.phaseClearanceTimes = trafficEnv.phaseClearanceTimes
+        self.phaseNum = 0
+        self.greenTimeout = None
+        # The offset delays the whole cycle, it lines sites up along a corridor.
+        kernel.schedule(offset + self.phaseClearanceTimes[0], self.amber_on)
+
+    def amber_on(self):
+        for light in self.phaseLights[self.phaseNum]:
+            light.change_state('amber')
+        self.kernel.schedule(traffic_phases.AMBER_TIME, self.green_on)
+
+    def green_on(self):
+        lights = self.phaseLights[self.phaseNum]
+        for light in lights:
+            light.change_state('green')
+        if self.sensors_clear():
+            self.green_off()
+        else:
+            for light in lights:
+                light.trafficManagement = self
+            self.greenTimeout = self.kernel.schedule(self.phaseGreenTimes[self.phaseNum], self.green_off)
+
+    def sensors_clear(self):
+        # The green only ends early once every sensor of the phase has seen the queue empty.
+        return all(light.movementState == 'none' for light in self.phaseLights[self.phaseNum])
+
+    def sensor_off(self):
+        if self.sensors_clear():
+            self.green_off()
+
+    def green_off(self):
+        self.kernel.cancel(self.greenTimeout)
+        self.greenTimeout = None
+        for light in self.phaseLights[self.phaseNum]:
+            light.trafficManagement = None
+            light.change_state('amber')
+        self.kernel.schedule(traffic_phases.AMBER_TIME, self.red_on)
+
+    def red_on(self):
+        for light in self.phaseLights[self.phaseNum]:
+            light.change_state('red')
+        self.phaseNum = (self.phaseNum + 1) % len(self.phaseLights)
+        self.kernel.schedule(self.phaseClearanceTimes[self.phaseNum], self.amber_on)
+
+
+class TrafficEnvironment():
+
+    def __init__(self, kernel, envData, timeLightGreen, arrivalStreams, recordObservations=False, offset=0):
+        self.lightList = []
+        for lightData in envData['lightData']:
+            self.lightList.append(Light(kernel, sensitivity=lightData['sensorSensitivity'], busyness=lightData['busyness'], recordDepartures=recordObservations))
+        self.queueObservations = [] if recordObservations else None
+        self.phases = traffic_phases.site_phases(envData)
+        self.phaseClearanceTimes = traffic_phases.phase_clearance_times(envData, self.phases)
+        self.timeLightGreen = timeLightGreen
+        self.phaseGreenTimes = traffic_phases.phase_green_times(timeLightGreen, len(self.phases))
+        self.timeUpQueue = envData['timeUpQueue']
+
+        self.vehicleSpawner = VehicleSpawner(kernel, self, arrivalStreams, self.queueObservations)
+        self.trafficManagement = TrafficManagement(kernel, self, offset)
+
+
+class Light():
+    __slots__ = ('kernel', 'state', 'movementSensorSensitivity', 'movementState', 'busyness',
+                 'queueLength', 'firstVehicle', 'lastVehicle', 'sensorTimer', 'trafficManagement', 'waitingTimeStats', 'maxQueueLength',
+                 'minQueueLength', 'departures', 'link')
+
+    def __init__(self, kernel, sensitivity, busyness, recordDepartures=False):
+        self.kernel = kernel
+        self.state = 'red'
+        self.movementSensorSensitivity = sensitivity
+        self.movementState = 'movement'
+        self.busyness = busyness
+        self.queueLength = 0
+        self.firstVehicle = None
+        self.lastVehicle = None
+        self.sensorTimer = None
+        # Set while TrafficManagement is waiting on this light's sensor during green.
+        self.trafficManagement = None
+        self.waitingTimeStats = traffic_stats.StreamingStats()
+        self.maxQueueLength = 0
+        self.minQueueLength = 0
+        self.departures = [] if recordDepartures else None
+        # Where vehicles go once they leave, only set for a light along a corridor.
+        self.link = None
+        if self.movementSensorSensitivity != -1:
+            self.sensorTimer = kernel.schedule(self.movementSensorSensitivity, self.sensor_timer)
+
+    def sensor_timer(self):
+        self.sensorTimer = None
+        self.movementState = 'none'
+        if self.trafficManagement is not None:
+            self.trafficManagement.sensor_off()
+
+    def add_vehicle(self, vehicle):
+        self.queueLength += 1
+        if self.queueLength > self.maxQueueLength:
+            self.maxQueueLength = self.queueLength
+        vehicle.vehicleInFront = self.lastVehicle
+        if self.lastVehicle is not None:
+            self.lastVehicle.vehicleBehind = vehicle
+        else:
+            self.firstVehicle = vehicle
+        self.lastVehicle = vehicle
+        if self.movementSensorSensitivity != -1:
+            self.kernel.cancel(self.sensorTimer)
+            self.sensorTimer = None
+            self.movementState = 'movement'
+
+    def remove_vehicle(self, vehicle):
+        self.queueLength -= 1
+        if self.queueLength < self.minQueueLength:
+            self.minQueueLength = self.queueLength
+        self.waitingTimeStats.add(self.kernel.now - vehicle.arrivalTime)
+        if self.departures is not None:
+            self.departures.append((vehicle.arrivalTime, self.kernel.now - vehicle.arrivalTime))
+        self.firstVehicle = vehicle.vehicleBehind
+        if vehicle.vehicleBehind is not None:
+            vehicle.vehicleBehind.vehicleInFront = None
+            vehicle.vehicleBehind = None
+        if self.lastVehicle is vehicle:
+            self.lastVehicle = None
+        if self.link is not None:
+            self.link.depart()
+        if self.movementSensorSensitivity != -1 and self.queueLength == 0:
+            self.sensorTimer = self.kernel.schedule(self.movementSensorSensitivity, self.sensor_timer)
+
+    def residual_queue_length(self):
+        # Shortest the queue has been since the last call.
+        residualQueueLength = self.minQueueLength
+        self.minQueueLength = self.queueLength
+        return residualQueueLength
+
+    def queued_waiting_times(self):
+        waitingTimes = []
+        vehicle = self.firstVehicle
+        while vehicle is not None:
+            waitingTimes.append(self.kernel.now - vehicle.arrivalTime)
+            vehicle = vehicle.vehicleBehind
+        return waitingTimes
+
+    def add_queued_waiting_times(self):
+        # Vehicles still queued when a run is aborted count with the time they have waited so far.
+        for waitingTime in self.queued_waiting_times():
+            self.waitingTimeStats.add(waitingTime)
+
+    def change_state(self, state):
+        self.state = state
+        # The vehicle at the front only waits for green once it has moved up.
+        if state == 'green' and self.firstVehicle is not None and self.firstVehicle.waitingForGreen:
+            self.kernel.schedule(0, self.firstVehicle.depart)
+
+
+class Link():
+    """Carries the vehicles leaving one light to the back of another light's queue travelTime later."""
+    __slots__ = ('kernel', 'light', 'trafficEnv', 'travelTime')
+
+    def __init__(self, kernel, light, trafficEnv, travelTime):
+        self.kernel = kernel
+        self.light = light
+        self.trafficEnv = trafficEnv
+        self.travelTime = travelTime
+
+    def depart(self):
+        self.kernel.schedule(self.travelTime, self.arrive)
+
+    def arrive(self):
+        Vehicle(self.kernel, self.light, self.trafficEnv)
+
+
+class Vehicle():
+    __slots__ = ('kernel', 'trafficEnv', 'atLight', 'arrivalTime', 'vehicleInFront', 'vehicleBehind',
+                 'moved', 'waitingForFront', 'waitingForGreen')
+
+    def __init__(self, kernel, light, trafficEnv):
+        self.kernel = kernel
+        self.trafficEnv = trafficEnv
+        self.atLight = light
+        self.arrivalTime = kernel.now
+        self.vehicleInFront = None
+        self.vehicleBehind = None
+        self.moved = False
+        self.waitingForFront = False
+        self.waitingForGreen = False
+        light.add_vehicle(self)
+        kernel.schedule(0, self.look_ahead)
+
+    def look_ahead(self):
+        if self.vehicleInFront is None:
+            if self.atLight.state == 'green':
+                self.depart()
+            else:
+                self.waitingForGreen = True
+        elif self.vehicleInFront.moved:
+            self.move_up()
+        else:
+            self.waitingForFront = True
+
+    def set_moved(self, vehicleBehind):
+        self.moved = True
+        if vehicleBehind is not None and vehicleBehind.waitingForFront:
+            vehicleBehind.waitingForFront = False
+            vehicleBehind.move_up()
+
+    def move_up(self):
+        self.kernel.schedule(self.trafficEnv.timeUpQueue, self.moved_up)
+
+    def moved_up(self):
+        self.set_moved(self.vehicleBehind)
+        self.kernel.schedule(traffic_phases.MOVED_PULSE_TIME, self.moved_pulse_end)
+
+    def moved_pulse_end(self):
+        self.moved = False
+        self.look_ahead()
+
+    def depart(self):
+        self.waitingForGreen = False
+        vehicleBehind = self.vehicleBehind
+        self.atLight.remove_vehicle(self)
+        # The vehicle behind is now at the front but still has to see this one move off.
+        self.set_moved(vehicleBehind)
+
+
+def run_replication(envData, lightGreenTime, envTime, lightSeeds=None, warmup=False):
+    """Waiting time StreamingStats, maximum queue length of each light and whether the replication was oversaturated.
+
+    With warmup the transient is dropped and the run stops once the estimate converges.
+    An oversaturated run is aborted early and its waiting times are a lower bound.
+    """
+    kernel = Kernel()
+    arrivalStreams = traffic_arrivals.arrival_streams(envData, lightSeeds)
+    trafficEnv = TrafficEnvironment(kernel, envData, lightGreenTime, arrivalStreams, recordObservations=warmup)
+    detector = traffic_saturation.SaturationDetector()
+
+    def run_till(till):
+        return detector.advance(kernel.run, lambda: [light.residual_queue_length() for light in trafficEnv.lightList], till)
+
+    if warmup:
+        def estimate():
+            return traffic_warmup.steady_state_waiting_times(trafficEnv.queueObservations, [light.departures for light in trafficEnv.lightList])
+        # Not stopped before the detector has had all its checks, so an oversaturated run is still caught.
+        warmupTime, lightWaitingStats, simulatedTime = traffic_warmup.run_until_converged(run_till, estimate, envTime, detector.interval * detector.checks)
+        if lightWaitingStats is not None:
+            lightWaitingStats = traffic_warmup.queued_fallback(lightWaitingStats, [light.queued_waiting_times() for light in trafficEnv.lightList])
+    else:
+        run_till(envTime)
+        lightWaitingStats = [light.waitingTimeStats for light in trafficEnv.lightList]
+    oversaturated = detector.abortTime is not None
+    if oversaturated:
+        for light in trafficEnv.lightList:
+            light.add_queued_waiting_times()
+        lightWaitingStats = [light.waitingTimeStats for light in trafficEnv.lightList]
+    return lightWaitingStats, [light.maxQueueLength for light in trafficEnv.lightList], oversaturated
+
+
+def run_observed(envData, lightGreenTime, envTime, lightSeeds=None):
+    """Total queue length every second, then for each light the (arrival, waiting) times of its departures,
+    the waiting times so far of its queued vehicles and its maximum queue length, the time the run ended
+    and whether it was aborted as oversaturated."""
+    kernel = Kernel()
+    arrivalStreams = traffic_arrivals.arrival_streams(envData, lightSeeds)
+    trafficEnv = TrafficEnvironment(kernel, envData, lightGreenTime, arrivalStreams, recordObservations=True)
+    detector = traffic_saturation.SaturationDetector()
+    abortTime = detector.advance(kernel.run, lambda: [light.residual_queue_length() for light in trafficEnv.lightList], envTime)
+    return (trafficEnv.queueObservations, [light.departures for light in trafficEnv.lightList], [light.queued_waiting_times() for light in trafficEnv.lightList],
+            [light.maxQueueLength for light in trafficEnv.lightList], envTime if abortTime is None else abortTime, abortTime is not None)
@@ -6,72 +6,119 @@ Author: Edward Upton (engiego)
 
 import salabim as sim
 import time
-import matplotlib
-matplotlib.use("TkAgg")
-from matplotlib import pyplot as plt
 from scipy.interpolate import make_interp_spline, BSpline
 import random
 import numpy as np
 import uuid
 import os
 import pickle
+import concurrent.futures
+import queue
+import threading
+
+import green_time_search
+import traffic_arrivals
+import traffic_env_batch
+import traffic_env_estimate
+import traffic_cache
+import traffic_env_kernel
+import traffic_phases
+import traffic_progress
+import traffic_render
+import traffic_saturation
+import traffic_stats
+import traffic_warmup
 
 CWD = os.path.dirname(os.path.realpath(__file__))
 
 VIEWPORT_RESOLUTION = [2560,1600]
-PERCENTAGE_TIME_SAFETY_ADDITION = 0.2
+ENGINES = ['salabim', 'kernel', 'batch']
+SEARCH_MODES = ['grid', 'golden', 'refine', 'pattern']
+ESTIMATORS = ['replications', 'batchMeans']
+ADAPTIVE_MIN_ITERATIONS = 3
+ADAPTIVE_CI_TARGET_WIDTH = 2.0
+# Bumped whenever a change to the salabim model would change seeded results.
+SALABIM_ENGINE_VERSION = 2
+# Bumped whenever what is stored for a cached result changes.
+CACHE_RESULT_FORMAT = 5
 
 class VehicleSpawner(sim.Component):
 
-    def setup(self, trafficEnv):
+    def setup(self, trafficEnv, envData, lightSeeds=None):
         self.trafficEnv = trafficEnv
         self.lightList = trafficEnv.lightList
-        self.randomUniform = sim.Uniform(0,1)
+        self.queueObservations = trafficEnv.queueObservations
+        # Each light has its own arrivals so they do not depend on the other lights.
+        self.arrivalStreams = traffic_arrivals.arrival_streams(envData, lightSeeds)
 
     def process(self):
         while True:
-            for light in self.lightList:
-                if light.busyness > self.randomUniform.sample():
+            now = self.env.now()
+            if self.queueObservations is not None:
+                self.queueObservations.append(sum(len(light.vehiclesQueue) for light in self.lightList))
+            for light, arrivalStream in zip(self.lightList, self.arrivalStreams):
+                if arrivalStream.nextArrival <= now:
+                    arrivalStream.advance()
                     Vehicle(light=light, trafficEnv=self.trafficEnv)
-            yield self.hold(1)
+            if self.queueObservations is not None:
+                # The queue is still sampled every second for the warm-up detection.
+                yield self.hold(1)
+            else:
+                nextArrival = min(arrivalStream.nextArrival for arrivalStream in self.arrivalStreams)
+                if nextArrival == float('inf'):
+                    yield self.passivate()
+                # Woken a second early so the arrival is queued against other events due
+                # at the same time just as it was when the spawner ticked every second.
+                if nextArrival > now + 1:
+                    yield self.hold(till=nextArrival - 1)
+                yield self.hold(1)
 
 
 class TrafficManagement(sim.Component):
 
     def setup(self, trafficEnv):
         self.trafficEnv = trafficEnv
-        self.lightList = trafficEnv.lightList
-        self.timeLightGreen = trafficEnv.timeLightGreen
-        self.timeLtoLSafety = trafficEnv.timeLtoLSafety
+        self.phaseLights = [[trafficEnv.lightList[lightNum] for lightNum in phase] for phase in trafficEnv.phases]
+        self.phaseGreenTimes = trafficEnv.phaseGreenTimes
+        self.phaseClearanceTimes = trafficEnv.phaseClearanceTimes
 
     def process(self):
         while True:
-            for light in self.lightList:
-                yield self.hold(self.timeLtoLSafety)
-                light.change_state(state='amber')
-                yield self.hold(1)
-                light.change_state(state='green')
-                yield self.wait((light.movementState, 'none'), fail_delay=self.timeLightGreen)
-                light.change_state(state='amber')
-                yield self.hold(1)
-                light.change_state(state='red')
+            for lights, clearanceTime, greenTime in zip(self.phaseLights, self.phaseClearanceTimes, self.phaseGreenTimes):
+                yield self.hold(clearanceTime)
+                for light in lights:
+                    light.change_state(state='amber')
+                yield self.hold(traffic_phases.AMBER_TIME)
+                for light in lights:
+                    light.change_state(state='green')
+                # The green only ends early once every sensor of the phase has seen the queue empty.
+                yield self.wait(*[(light.movementState, 'none') for light in lights], all=True, fail_delay=greenTime)
+                for light in lights:
+                    light.change_state(state='amber')
+                yield self.hold(traffic_phases.AMBER_TIME)
+                for light in lights:
+                    light.change_state(state='red')
 
 
 class TrafficEnvironment():
 
-    def __init__(self, envData, timeLightGreen):
+    def __init__(self, envData, timeLightGreen, lightSeeds=None, recordObservations=False):
         self.lightList = []
-        for lightNum in range(2):
-            self.lightList.append(Light(sensitivity=envData['lightData'][lightNum]['sensorSensitivity'], busyness=envData['lightData'][lightNum]['busyness']))
+        for lightData in envData['lightData']:
+            self.lightList.append(Light(sensitivity=lightData['sensorSensitivity'], busyness=lightData['busyness'], recordDepartures=recordObservations))
+        self.queueObservations = [] if recordObservations else None
         self.roadBetween = RoadBetween()
         self.distanceLtoL = envData['lightDistance']
         self.speed = envData['speed'] / 2.237
         self.timeLtoL = self.distanceLtoL / self.speed
-        self.timeLtoLSafety = self.timeLtoL * (1 + PERCENTAGE_TIME_SAFETY_ADDITION)
+        self.timeLtoLSafety = self.timeLtoL * (1 + traffic_phases.PERCENTAGE_TIME_SAFETY_ADDITION)
+        self.phases = traffic_phases.site_phases(envData)
+        self.phaseClearanceTimes = traffic_phases.phase_clearance_times(envData, self.phases)
         self.timeLightGreen = timeLightGreen
+        self.phaseGreenTimes = traffic_phases.phase_green_times(timeLightGreen, len(self.phases))
         self.timeUpQueue = envData['timeUpQueue']
 
-        self.vehicleSpawner = VehicleSpawner(trafficEnv=self)
+        self.vehicleSpawner = VehicleSpawner(trafficEnv=self, envData=envData, lightSeeds=lightSeeds)
         self.trafficManagement = TrafficManagement(trafficEnv=self)
 
 
@@ -79,32 +126,76 @@ class RoadBetween(sim.Component):
 
     def setup(self):
         self.vehiclesInBetweenBool = sim.State(
-            self.name() + ".vehiclesPresentState", value=False)
+            self.name() + ".vehiclesPresentState", value=False, monitor=False)
         self.vehiclesQueue = sim.Queue(
-            self.name() + ".vehiclesQueue")
+            self.name() + ".vehiclesQueue", monitor=False)
 
 
 class Light(sim.Component):
 
-    def setup(self, sensitivity, busyness):
-        self.state = sim.State((self.name() + ".state"), value="red")
-        self.vehiclesQueue = sim.Queue(self.name() + ".queue")
+    def setup(self, sensitivity, busyness, recordDepartures=False):
+        self.state = sim.State((self.name() + ".state"), value="red", monitor=False)
+        # Salabim's queue monitors keep every sample, these keep a fixed size summary instead.
+        self.vehiclesQueue = sim.Queue(self.name() + ".queue", monitor=False)
+        self.waitingTimeStats = traffic_stats.StreamingStats()
+        self.queueLengthStats = traffic_stats.LevelStats(0, self.env.now())
+        self.minQueueLength = 0
         self.movementSensorSensitivity = sensitivity
-        self.movementState = sim.State(self.name() + ".movementState", value='movement')
+        self.movementState = sim.State(self.name() + ".movementState", value='movement', monitor=False)
         self.busyness = busyness
+        self.lastVehicle = None
+        self.departures = [] if recordDepartures else None
 
-    def process(self):
-        while True:
-            if self.movementSensorSensitivity == -1:
-                pass
-            else:
-                if len(self.vehiclesQueue) == 0:
-                    yield self.hold(self.movementSensorSensitivity)
-                    if len(self.vehiclesQueue) == 0:
-                        self.movementState.set('none')
-                elif len(self.vehiclesQueue) > 0:
-                    self.movementState.set('movement')
-            yield self.hold(0.1)
+        if self.movementSensorSensitivity != -1:
+            self.activate(process='sensor_timer')
+
+    def sensor_timer(self):
+        yield self.hold(self.movementSensorSensitivity)
+        self.movementState.set('none')
+
+    def add_vehicle(self, vehicle):
+        self.vehiclesQueue.add(vehicle)
+        self.queueLengthStats.set(len(self.vehiclesQueue), self.env.now())
+        # Vehicles keep hold of their neighbours so nobody has to search the queue.
+        vehicle.vehicleInFront = self.lastVehicle
+        if self.lastVehicle is not None:
+            self.lastVehicle.vehicleBehind = vehicle
+        self.lastVehicle = vehicle
+        if self.movementSensorSensitivity != -1:
+            # A vehicle arriving disarms the sensor until the queue empties again.
+            if self.isscheduled():
+                self.cancel()
+            self.movementState.set('movement')
+
+    def remove_vehicle(self, vehicle):
+        arrivalTime = vehicle.enter_time(self.vehiclesQueue)
+        self.waitingTimeStats.add(self.env.now() - arrivalTime)
+        if self.departures is not None:
+            self.departures.append((arrivalTime, self.env.now() - arrivalTime))
+        self.vehiclesQueue.remove(vehicle)
+        self.queueLengthStats.set(len(self.vehiclesQueue), self.env.now())
+        self.minQueueLength = min(self.minQueueLength, len(self.vehiclesQueue))
+        if vehicle.vehicleBehind is not None:
+            vehicle.vehicleBehind.vehicleInFront = None
+            vehicle.vehicleBehind = None
+        if self.lastVehicle is vehicle:
+            self.lastVehicle = None
+        if self.movementSensorSensitivity != -1 and len(self.vehiclesQueue) == 0:
+            self.activate(process='sensor_timer')
+
+    def residual_queue_length(self):
+        # Shortest the queue has been since the last call.
+        residualQueueLength = self.minQueueLength
+        self.minQueueLength = len(self.vehiclesQueue)
+        return residualQueueLength
+
+    def queued_waiting_times(self):
+        return [self.env.now() - vehicle.enter_time(self.vehiclesQueue) for vehicle in self.vehiclesQueue]
+
+    def add_queued_waiting_times(self):
+        # Vehicles still queued when a run is aborted count with the time they have waited so far.
+        for waitingTime in self.queued_waiting_times():
+            self.waitingTimeStats.add(waitingTime)
 
     def change_state(self, state):
         self.state.set(state)
@@ -116,68 +207,518 @@ class Vehicle(sim.Component):
         self.trafficEnv = trafficEnv
         self.roadBetween = trafficEnv.roadBetween
         self.atLight = light
-        self.movedState = sim.State(self.name() + ".movedState")
-        self.atLight.vehiclesQueue.add(self)
+        self.movedState = sim.State(self.name() + ".movedState", monitor=False)
+        self.vehicleInFront = None
+        self.vehicleBehind = None
+        self.atLight.add_vehicle(self)
 
     def process(self):
-        while True:
-            if self.atLight.vehiclesQueue.index(self) == 0:
-                yield self.wait((self.atLight.state, 'green'))
-                # Travelling Between Lights
-                self.roadBetween.vehiclesQueue.add(self)
-                self.roadBetween.vehiclesInBetweenBool.set(True)
-                self.atLight.vehiclesQueue.remove(self)
-                self.movedState.set()
-                yield self.hold(self.trafficEnv.timeLtoLSafety)
-                self.roadBetween.vehiclesQueue.remove(self)
-                if len(self.roadBetween.vehiclesQueue) == 0:
-                    self.roadBetween.vehiclesInBetweenBool.set(False)
-            elif self not in self.atLight.vehiclesQueue:
-                break
-            else:
-                vehicleInFront = self.atLight.vehiclesQueue[self.atLight.vehiclesQueue.index(self)-1]
-                yield self.wait(vehicleInFront.movedState)
-                # Moving Up Queue
-                yield self.hold(self.trafficEnv.timeUpQueue)
-                self.movedState.set()
-                yield self.hold(0.01)
-                self.movedState.set(False)
-                self.process()
-
-def run_optimisation(envData, optData):
-    dataArray = []
-    for lightGreenTime in range(int(optData['lightGreenTimeRange'][0]), int(optData['lightGreenTimeRange'][1]), int(optData['lightGreenTimeStep'])):
-        runningAverageTotal = 0
-        for iter in range(int(optData['iterationsPerSetting'])):
-            averageWaitingTime = 0
-            sim.random_seed = time.time()
-            print("Current Light Green Time:,", lightGreenTime, ", Iteration:", iter)
-            env = sim.Environment(trace=False, random_seed=time.time())
-            trafficEnv = TrafficEnvironment(envData, lightGreenTime)
-            env.run(int(optData['envTime']))
-            averageWaitingTime = sum([trafficEnv.lightList[0].vehiclesQueue.length_of_stay.mean(), trafficEnv.lightList[1].vehiclesQueue.length_of_stay.mean()]) / 2
-            runningAverageTotal += averageWaitingTime
-            print("Average Waiting Time For Car:", averageWaitingTime)
-        dataArray.append([lightGreenTime, runningAverageTotal/int(optData['iterationsPerSetting'])])
+        while self.vehicleInFront is not None:
+            yield self.wait(self.vehicleInFront.movedState)
+            # Moving Up Queue
+            yield self.hold(self.trafficEnv.timeUpQueue)
+            self.movedState.set()
+            yield self.hold(traffic_phases.MOVED_PULSE_TIME)
+            self.movedState.set(False)
+        yield self.wait((self.atLight.state, 'green'))
+        # Travelling Between Lights
+        self.roadBetween.vehiclesQueue.add(self)
+        self.roadBetween.vehiclesInBetweenBool.set(True)
+        self.atLight.remove_vehicle(self)
+        self.movedState.set()
+        yield self.hold(self.trafficEnv.timeLtoLSafety)
+        self.roadBetween.vehiclesQueue.remove(self)
+        if len(self.roadBetween.vehiclesQueue) == 0:
+            self.roadBetween.vehiclesInBetweenBool.set(False)
+
+def replication_seeds(seed, iteration, lightCount):
+    # Replication iteration of every green time sees the same arrivals, each light from its own stream.
+    return [int(np.random.SeedSequence([seed, iteration, lightNum]).generate_state(1)[0]) for lightNum in range(lightCount)]
+
+def engine_version(engine):
+    if engine == 'kernel':
+        return 'kernel-' + str(traffic_env_kernel.ENGINE_VERSION)
+    if engine == 'batch':
+        return 'batch-' + str(traffic_env_batch.ENGINE_VERSION)
+    return 'salabim-' + str(SALABIM_ENGINE_VERSION) + '-' + sim.__version__
+
+def result_key(envData, optData, lightGreenTime, **keyData):
+    # Everything that decides a seeded result, green times as floats so 30 and 30.0 share a result.
+    scenario = {key: envData[key] for key in ['lightDistance', 'speed', 'timeUpQueue', 'lightData']}
+    for key in ['clearanceTimes', 'phases']:
+        if envData.get(key) is not None:
+            scenario[key] = envData[key]
+    lightGreenTime = traffic_phases.green_time_value(lightGreenTime)
+    return traffic_cache.result_key(resultFormat=CACHE_RESULT_FORMAT, scenario=scenario, envTime=int(optData['envTime']), engine=engine_version(optData.get('engine', 'salabim')),
+                                    warmup=bool(optData.get('warmup', False)), seed=optData['seed'],
+                                    lightGreenTime=lightGreenTime if isinstance(lightGreenTime, list) else float(lightGreenTime), **keyData)
+
+def run_replication(envData, lightGreenTime, envTime, engine, lightSeeds=None, warmup=False):
+    # Waiting time StreamingStats, maximum queue length of each light and whether the replication was oversaturated.
+    if engine == 'kernel':
+        return traffic_env_kernel.run_replication(envData, lightGreenTime, envTime, lightSeeds, warmup)
+    sim.random_seed = time.time()
+    env = sim.Environment(trace=False, random_seed=time.time())
+    trafficEnv = TrafficEnvironment(envData, lightGreenTime, lightSeeds, recordObservations=warmup)
+    detector = traffic_saturation.SaturationDetector()
+
+    def run_till(till):
+        return detector.advance(lambda checkTime: env.run(till=checkTime), lambda: [light.residual_queue_length() for light in trafficEnv.lightList], till)
+
+    if warmup:
+        def estimate():
+            return traffic_warmup.steady_state_waiting_times(trafficEnv.queueObservations, [light.departures for light in trafficEnv.lightList])
+        # Not stopped before the detector has had all its checks, so an oversaturated run is still caught.
+        warmupTime, lightWaitingStats, simulatedTime = traffic_warmup.run_until_converged(run_till, estimate, envTime, detector.interval * detector.checks)
+        if lightWaitingStats is not None:
+            lightWaitingStats = traffic_warmup.queued_fallback(lightWaitingStats, [light.queued_waiting_times() for light in trafficEnv.lightList])
+    else:
+        run_till(envTime)
+        lightWaitingStats = [light.waitingTimeStats for light in trafficEnv.lightList]
+    oversaturated = detector.abortTime is not None
+    if oversaturated:
+        for light in trafficEnv.lightList:
+            light.add_queued_waiting_times()
+        lightWaitingStats = [light.waitingTimeStats for light in trafficEnv.lightList]
+    return lightWaitingStats, [int(light.queueLengthStats.until(env.now()).maximum) for light in trafficEnv.lightList], oversaturated
+
+def run_observed(envData, lightGreenTime, envTime, engine, lightSeeds=None):
+    if engine == 'kernel':
+        return traffic_env_kernel.run_observed(envData, lightGreenTime, envTime, lightSeeds)
+    sim.random_seed = time.time()
+    env = sim.Environment(trace=False, random_seed=time.time())
+    trafficEnv = TrafficEnvironment(envData, lightGreenTime, lightSeeds, recordObservations=True)
+    detector = traffic_saturation.SaturationDetector()
+    abortTime = detector.advance(lambda checkTime: env.run(till=checkTime), lambda: [light.residual_queue_length() for light in trafficEnv.lightList], envTime)
+    return (trafficEnv.queueObservations, [light.departures for light in trafficEnv.lightList], [light.queued_waiting_times() for light in trafficEnv.lightList],
+            [int(light.queueLengthStats.until(env.now()).maximum) for light in trafficEnv.lightList], envTime if abortTime is None else abortTime, abortTime is not None)
+
+def run_batch_means(envData, optData, lightGreenTime):
+    # One run as long as all the replications together, split into batches after a single warm-up.
+    runTime = int(optData['envTime']) * int(optData['iterationsPerSetting'])
+    seed = optData.get('seed')
+    lightSeeds = None if seed is None else replication_seeds(seed, 0, len(envData['lightData']))
+    (queueObservations, lightDepartures, lightQueuedWaitingTimes, lightMaxQueueLengths,
+     endTime, oversaturated) = run_observed(envData, lightGreenTime, runTime, optData.get('engine', 'salabim'), lightSeeds)
+    batchCount = int(optData.get('batchCount', traffic_warmup.BATCH_MEANS_COUNT))
+    weights = traffic_stats.objective_weights(optData.get('objective', traffic_stats.OBJECTIVE))
+    warmupTime, batchValues, lightWaitingStats = traffic_warmup.batch_means(queueObservations, lightDepartures, endTime, batchCount, weights)
+    if oversaturated:
+        # As in an aborted replication the vehicles still queued count with the time they have waited so far.
+        for waitingTimeStats, queuedWaitingTimes in zip(lightWaitingStats, lightQueuedWaitingTimes):
+            waitingTimeStats.merge(traffic_stats.StreamingStats.from_values(queuedWaitingTimes))
+    lightWaitingStats = traffic_warmup.queued_fallback(lightWaitingStats, lightQueuedWaitingTimes)
+    if not batchValues:
+        # Nothing arriving after the warm-up got through, the setting is scored from the queued vehicles instead.
+        batchValues = [traffic_stats.objective_value(lightWaitingStats, weights)]
+    return batchValues, lightWaitingStats, lightMaxQueueLengths, oversaturated
+
+def record_distribution(distributions, lightGreenTime, lightWaitingStats, lightMaxQueueLengths, oversaturated=False):
+    # Every replication of a green time merged into one waiting time distribution and maximum queue per light.
+    if distributions is None:
+        return
+    if lightGreenTime not in distributions:
+        distributions[lightGreenTime] = {'lightWaitingStats': [traffic_stats.StreamingStats() for waitingTimeStats in lightWaitingStats],
+                                         'maxQueueLengths': [0] * len(lightMaxQueueLengths),
+                                         'replicationCount': 0,
+                                         'oversaturatedCount': 0}
+    distribution = distributions[lightGreenTime]
+    distribution['replicationCount'] += 1
+    if oversaturated:
+        distribution['oversaturatedCount'] += 1
+    for mergedStats, waitingTimeStats in zip(distribution['lightWaitingStats'], lightWaitingStats):
+        mergedStats.merge(waitingTimeStats)
+    distribution['maxQueueLengths'] = [max(maxQueueLength, lightMaxQueueLength) for maxQueueLength, lightMaxQueueLength in zip(distribution['maxQueueLengths'], lightMaxQueueLengths)]
+
+def is_oversaturated(distributions, lightGreenTime):
+    # A green time counts as oversaturated once most of its replications were aborted, a stable
+    # setting near capacity has the odd replication whose queue wanders far enough to be aborted.
+    if lightGreenTime not in distributions:
+        return False
+    distribution = distributions[lightGreenTime]
+    return 2 * distribution['oversaturatedCount'] > distribution['replicationCount']
+
+def ranking_value(averageWaitingTime, oversaturated, envTime):
+    # An oversaturated setting only has a lower bound on its waiting time, so it is ranked
+    # after every setting that kept up with the demand, whose waiting times are below envTime.
+    return averageWaitingTime + envTime if oversaturated else averageWaitingTime
+
+def simulate_replications(envData, optData, replications, executor=None, cache=None, progress=None):
+    # Waiting time StreamingStats and maximum queue length of each light for each (light green time, iteration) pair.
+    weights = traffic_stats.objective_weights(optData.get('objective', traffic_stats.OBJECTIVE))
+    if cache is not None:
+        keys = [result_key(envData, optData, lightGreenTime, iteration=iter) for lightGreenTime, iter in replications]
+        results = [cache.get(key) for key in keys]
+        missing = [index for index, result in enumerate(results) if result is None]
+        if len(missing) < len(replications):
+            print("Reusing", len(replications) - len(missing), "cached replications")
+        if progress is not None:
+            for (lightGreenTime, iter), result in zip(replications, results):
+                if result is not None:
+                    progress.replication_done(lightGreenTime, iter, traffic_stats.objective_value(result[0], weights), cached=True, oversaturated=result[2])
+        simulated = simulate_replications(envData, optData, [replications[index] for index in missing], executor, progress=progress) if missing else []
+        for index, result in zip(missing, simulated):
+            results[index] = result
+            cache.put(keys[index], result)
+        return results
+    if executor is not None:
+        return simulate_replications_parallel(envData, optData, replications, executor, progress)
+    engine = optData.get('engine', 'salabim')
+    seed = optData.get('seed')
+    lightCount = len(envData['lightData'])
+    envTime = int(optData['envTime'])
+    if engine == 'batch':
+        print("Simulating", len(replications), "replications with the batch engine")
+        results = []
+        # One chunk at a time so progress is reported while a long sweep runs.
+        for start in range(0, len(replications), traffic_env_batch.BATCH_CHUNK_SIZE):
+            chunk = replications[start:start + traffic_env_batch.BATCH_CHUNK_SIZE]
+            lightSeeds = None
+            if seed is not None:
+                lightSeeds = [replication_seeds(seed, iter, lightCount) for lightGreenTime, iter in chunk]
+            chunkResults = traffic_env_batch.run_batch_distributions(envData, [lightGreenTime for lightGreenTime, iter in chunk], envTime, lightSeeds)
+            for (lightGreenTime, iter), result in zip(chunk, chunkResults):
+                results.append(result)
+                if progress is not None:
+                    progress.replication_done(lightGreenTime, iter, traffic_stats.objective_value(result[0], weights), oversaturated=result[2])
+        return results
+    results = []
+    for lightGreenTime, iter in replications:
+        print("Current Light Green Time:,", lightGreenTime, ", Iteration:", iter)
+        lightSeeds = None if seed is None else replication_seeds(seed, iter, lightCount)
+        result = run_replication(envData, lightGreenTime, envTime, engine, lightSeeds, optData.get('warmup', False))
+        results.append(result)
+        objectiveValue = traffic_stats.objective_value(result[0], weights)
+        print("Objective Waiting Time For Car:", objectiveValue, "(oversaturated, lower bound)" if result[2] else "")
+        if progress is not None:
+            progress.replication_done(lightGreenTime, iter, objectiveValue, oversaturated=result[2])
+    return results
+
+def simulate_settings(envData, optData, lightGreenTimes, executor=None, cache=None, progress=None, distributions=None):
+    # Objective samples for each green time, either replications or the batches of one long run.
+    weights = traffic_stats.objective_weights(optData.get('objective', traffic_stats.OBJECTIVE))
+    if optData.get('estimator', 'replications') == 'batchMeans':
+        batchKeyData = {'estimator': 'batchMeans', 'iterationsPerSetting': int(optData['iterationsPerSetting']),
+                        'batchCount': int(optData.get('batchCount', traffic_warmup.BATCH_MEANS_COUNT)), 'objective': weights}
+        settingResults = {}
+        if cache is not None:
+            for lightGreenTime in lightGreenTimes:
+                result = cache.get(result_key(envData, optData, lightGreenTime, **batchKeyData))
+                if result is not None:
+                    settingResults[lightGreenTime] = result
+        if progress is not None:
+            # A whole long run counts as one replication of its green time.
+            progress.expect(len(lightGreenTimes))
+            for lightGreenTime, (batchValues, lightWaitingStats, lightMaxQueueLengths, oversaturated) in settingResults.items():
+                progress.replication_done(lightGreenTime, 0, sum(batchValues) / len(batchValues), cached=True, oversaturated=oversaturated)
+        missingGreenTimes = [lightGreenTime for lightGreenTime in lightGreenTimes if lightGreenTime not in settingResults]
+        if executor is None:
+            results = [run_batch_means(envData, optData, lightGreenTime) for lightGreenTime in missingGreenTimes]
+        else:
+            results = executor.map(run_batch_means, [envData] * len(missingGreenTimes), [optData] * len(missingGreenTimes), missingGreenTimes)
+        for lightGreenTime, result in zip(missingGreenTimes, results):
+            settingResults[lightGreenTime] = result
+            if cache is not None:
+                cache.put(result_key(envData, optData, lightGreenTime, **batchKeyData), result)
+            if progress is not None:
+                progress.replication_done(lightGreenTime, 0, sum(result[0]) / len(result[0]), oversaturated=result[3])
+        settingWaitingTimes = {}
+        for lightGreenTime in lightGreenTimes:
+            batchValues, lightWaitingStats, lightMaxQueueLengths, oversaturated = settingResults[lightGreenTime]
+            settingWaitingTimes[lightGreenTime] = batchValues
+            record_distribution(distributions, lightGreenTime, lightWaitingStats, lightMaxQueueLengths, oversaturated)
+            averageWaitingTime, halfWidth = traffic_stats.confidence_interval(batchValues)
+            print("Light Green Time:", lightGreenTime, ", Batch Means Waiting Time For Car:", averageWaitingTime, "+/-", halfWidth)
+        return settingWaitingTimes
+    iterations = int(optData['iterationsPerSetting'])
+    replications = [(lightGreenTime, iter) for lightGreenTime in lightGreenTimes for iter in range(iterations)]
+    settingWaitingTimes = {lightGreenTime: [] for lightGreenTime in lightGreenTimes}
+    if progress is not None:
+        progress.expect(len(replications))
+    for (lightGreenTime, iter), (lightWaitingStats, lightMaxQueueLengths, oversaturated) in zip(replications, simulate_replications(envData, optData, replications, executor, cache, progress)):
+        settingWaitingTimes[lightGreenTime].append(traffic_stats.objective_value(lightWaitingStats, weights))
+        record_distribution(distributions, lightGreenTime, lightWaitingStats, lightMaxQueueLengths, oversaturated)
+    return settingWaitingTimes
+
+def simulate_replications_parallel(envData, optData, replications, executor, progress=None):
+    # The batch engine gets one block per worker, the others one replication per task.
+    workers = int(optData['workers'])
+    weights = traffic_stats.objective_weights(optData.get('objective', traffic_stats.OBJECTIVE))
+    if optData.get('engine', 'salabim') == 'batch':
+        chunkSize = max(1, -(-len(replications) // workers))
+    else:
+        chunkSize = 1
+    futures = {}
+    for start in range(0, len(replications), chunkSize):
+        future = executor.submit(simulate_replications, envData, optData, replications[start:start + chunkSize])
+        futures[future] = start
+    results = [None] * len(replications)
+    for future in concurrent.futures.as_completed(futures):
+        start = futures[future]
+        for offset, result in enumerate(future.result()):
+            results[start + offset] = result
+            objectiveValue = traffic_stats.objective_value(result[0], weights)
+            print("Finished Light Green Time:", replications[start + offset][0], ", Iteration:", replications[start + offset][1], ", Objective Waiting Time For Car:", objectiveValue)
+            if progress is not None:
+                progress.replication_done(replications[start + offset][0], replications[start + offset][1], objectiveValue, oversaturated=result[2])
+    return results
+
+def run_adaptive(envData, optData, lightGreenTimes, executor=None, cache=None, progress=None, distributions=None):
+    # Keep adding replications to a setting until its confidence interval is narrow
+    # enough, it is clearly worse than the best setting so far, or it hits the maximum.
+    minIterations = int(optData.get('minIterations', ADAPTIVE_MIN_ITERATIONS))
+    maxIterations = int(optData['iterationsPerSetting'])
+    targetWidth = float(optData.get('ciTargetWidth', ADAPTIVE_CI_TARGET_WIDTH))
+    confidenceLevel = float(optData.get('confidenceLevel', traffic_stats.CONFIDENCE_LEVEL))
+    weights = traffic_stats.objective_weights(optData.get('objective', traffic_stats.OBJECTIVE))
+    if distributions is None:
+        distributions = {}
+    settingWaitingTimes = {lightGreenTime: [] for lightGreenTime in lightGreenTimes}
+    activeGreenTimes = list(lightGreenTimes)
+    while activeGreenTimes:
+        replications = []
+        for lightGreenTime in activeGreenTimes:
+            done = len(settingWaitingTimes[lightGreenTime])
+            for iter in range(done, max(done + 1, min(minIterations, maxIterations))):
+                replications.append((lightGreenTime, iter))
+        if progress is not None:
+            progress.expect(len(replications))
+        for (lightGreenTime, iter), (lightWaitingStats, lightMaxQueueLengths, oversaturated) in zip(replications, simulate_replications(envData, optData, replications, executor, cache, progress)):
+            settingWaitingTimes[lightGreenTime].append(traffic_stats.objective_value(lightWaitingStats, weights))
+            record_distribution(distributions, lightGreenTime, lightWaitingStats, lightMaxQueueLengths, oversaturated)
+
+        intervals = {lightGreenTime: traffic_stats.confidence_interval(settingWaitingTimes[lightGreenTime], confidenceLevel) for lightGreenTime in lightGreenTimes}
+        # Oversaturated settings only have lower bounds, more replications of them will not make them the best.
+        stableGreenTimes = [lightGreenTime for lightGreenTime in lightGreenTimes if not is_oversaturated(distributions, lightGreenTime)]
+        bestMean, bestHalfWidth = min(intervals[lightGreenTime] for lightGreenTime in (stableGreenTimes or lightGreenTimes))
+        activeGreenTimes = [lightGreenTime for lightGreenTime in activeGreenTimes
+                            if not is_oversaturated(distributions, lightGreenTime)
+                            and len(settingWaitingTimes[lightGreenTime]) < maxIterations
+                            and 2 * intervals[lightGreenTime][1] > targetWidth
+                            and intervals[lightGreenTime][0] - intervals[lightGreenTime][1] <= bestMean + bestHalfWidth]
+    return settingWaitingTimes
+
+def run_search(envData, optData, searchMode, executor=None, cache=None, progress=None, distributions=None):
+    # Every evaluation is simulated the same way as a grid setting, recorded in order for the results page.
+    settingWaitingTimes = {}
+    searchTrace = []
+    if distributions is None:
+        distributions = {}
+    envTime = int(optData['envTime'])
+
+    def evaluate_many(lightGreenTimes):
+        newGreenTimes = [lightGreenTime for lightGreenTime in lightGreenTimes if lightGreenTime not in settingWaitingTimes]
+        if newGreenTimes:
+            settingWaitingTimes.update(simulate_settings(envData, optData, newGreenTimes, executor, cache, progress, distributions))
+        rankingValues = []
+        for lightGreenTime in lightGreenTimes:
+            averageWaitingTime = sum(settingWaitingTimes[lightGreenTime]) / len(settingWaitingTimes[lightGreenTime])
+            oversaturated = is_oversaturated(distributions, lightGreenTime)
+            searchTrace.append([lightGreenTime, averageWaitingTime, oversaturated])
+            print("Search evaluated Light Green Time:", lightGreenTime, ", Average Waiting Time For Car:", averageWaitingTime, "(oversaturated, lower bound)" if oversaturated else "")
+            rankingValues.append(ranking_value(averageWaitingTime, oversaturated, envTime))
+        return rankingValues
+
+    lower, upper = float(optData['lightGreenTimeRange'][0]), float(optData['lightGreenTimeRange'][1])
+    tolerance = float(optData.get('searchTolerance', green_time_search.SEARCH_TOLERANCE))
+    if searchMode == 'golden':
+        green_time_search.golden_section_search(lambda lightGreenTime: evaluate_many([lightGreenTime])[0], lower, upper, tolerance)
+    elif searchMode == 'pattern':
+        # Every phase gets its own green time in the form's range. The search starts from the
+        # best single green time for every phase, a compass search alone stalls when the best
+        # move is to shorten every green at once.
+        phaseCount = len(traffic_phases.site_phases(envData))
+        start, startValue = green_time_search.golden_section_search(lambda lightGreenTime: evaluate_many([(lightGreenTime,) * phaseCount])[0], lower, upper, tolerance)
+        green_time_search.pattern_search(evaluate_many, lower, upper, phaseCount, float(optData['lightGreenTimeStep']), tolerance, (start,) * phaseCount)
+    else:
+        # The coarse sweep uses the form's step, later levels only simulate around the best so far.
+        green_time_search.refine_search(evaluate_many, lower, upper, float(optData['lightGreenTimeStep']), tolerance)
+    return settingWaitingTimes, searchTrace
+
+def validate_options(optData, envData=None):
+    # Raises ValueError for options the optimiser cannot run together, or cannot run on envData's site.
+    engine = optData.get('engine', 'salabim')
+    if engine not in ENGINES:
+        raise ValueError("Unknown simulation engine: " + str(engine))
+    searchMode = optData.get('search', 'grid')
+    if searchMode not in SEARCH_MODES:
+        raise ValueError("Unknown search mode: " + str(searchMode))
+    estimator = optData.get('estimator', 'replications')
+    if estimator not in ESTIMATORS:
+        raise ValueError("Unknown estimator: " + str(estimator))
+    if (optData.get('warmup', False) or estimator == 'batchMeans') and engine == 'batch':
+        raise ValueError("Warm-up detection and batch means need the salabim or kernel engine")
+    if estimator == 'batchMeans' and optData.get('adaptive', False):
+        raise ValueError("Adaptive iterations need the replications estimator")
+    # The searches pick their own green times and replications, so these only apply to the grid.
+    if searchMode != 'grid' and optData.get('adaptive', False):
+        raise ValueError("Adaptive iterations need the grid search")
+    if searchMode != 'grid' and optData.get('prescreen', False):
+        raise ValueError("Pre-screening green times needs the grid search")
+    traffic_stats.objective_weights(optData.get('objective', traffic_stats.OBJECTIVE))
+    seed = optData.get('seed')
+    if seed is not None and (isinstance(seed, bool) or not isinstance(seed, int) or seed < 0):
+        raise ValueError("The random seed has to be a whole number of at least 0, got: " + str(seed))
+    if envData is not None and engine == 'batch':
+        traffic_env_batch.validate_site(envData)
+
+def optimise_green_time(envData, optData, progress=None, executor=None):
+    """Simulate the green times of one scenario and pick the best, without drawing or saving anything.
+
+    Returns the results and the [light green time, objective] curve, with green splits
+    as tuples. executor is an optional process pool to simulate on, it can be shared
+    between scenarios.
+    """
+    searchMode = optData.get('search', 'grid')
+    estimator = optData.get('estimator', 'replications')
+    objectiveWeights = traffic_stats.objective_weights(optData.get('objective', traffic_stats.OBJECTIVE))
+    lightGreenTimes = list(range(int(optData['lightGreenTimeRange'][0]), int(optData['lightGreenTimeRange'][1]), int(optData['lightGreenTimeStep'])))
+    seed = optData.get('seed')
+    prescreenEstimates = None
+    if optData.get('prescreen', False):
+        allGreenTimes = lightGreenTimes
+        tolerance = optData.get('prescreenTolerance', traffic_env_estimate.PRESCREEN_TOLERANCE)
+        lightGreenTimes, prescreenEstimates = traffic_env_estimate.prescreen_green_times(envData, allGreenTimes, int(optData['envTime']), tolerance)
+        print("Pre-screen kept", len(lightGreenTimes), "of", len(allGreenTimes), "green times:", lightGreenTimes)
+    # Only seeded results can be reused, an unseeded run is meant to see new arrivals every time.
+    cache = None
+    if seed is not None and optData.get('cache', True):
+        cache = traffic_cache.ResultCache(maxBytes=int(optData.get('cacheMaxBytes', traffic_cache.CACHE_MAX_BYTES)))
+    distributions = {}
+    try:
+        searchTrace = None
+        if searchMode != 'grid':
+            settingWaitingTimes, searchTrace = run_search(envData, optData, searchMode, executor, cache, progress, distributions)
+        elif optData.get('adaptive', False):
+            settingWaitingTimes = run_adaptive(envData, optData, lightGreenTimes, executor, cache, progress, distributions)
+            print("Replications used per setting:", {lightGreenTime: len(waitingTimes) for lightGreenTime, waitingTimes in settingWaitingTimes.items()})
+        else:
+            settingWaitingTimes = simulate_settings(envData, optData, lightGreenTimes, executor, cache, progress, distributions)
+    finally:
+        if cache is not None:
+            cache.evict()
+            print("Result cache hits:", cache.hits, ", misses:", cache.misses)
+    dataArray = [[lightGreenTime, sum(waitingTimes) / len(waitingTimes)] for lightGreenTime, waitingTimes in sorted(settingWaitingTimes.items())]
+    oversaturatedGreenTimes = [lightGreenTime for lightGreenTime, averageWaitingTime in dataArray if is_oversaturated(distributions, lightGreenTime)]
+
+    envTime = int(optData['envTime'])
+    xmin, ymin = min(dataArray, key=lambda point: ranking_value(point[1], point[0] in oversaturatedGreenTimes, envTime))
+
+    # Per light waiting time summary and maximum queue of every green time, all replications merged.
+    distributionSummaries = []
+    for lightGreenTime, distribution in sorted(distributions.items()):
+        lightSummaries = []
+        for waitingTimeStats, maxQueueLength in zip(distribution['lightWaitingStats'], distribution['maxQueueLengths']):
+            lightSummary = waitingTimeStats.summary()
+            lightSummary['maxQueueLength'] = maxQueueLength
+            lightSummaries.append(lightSummary)
+        distributionSummaries.append([traffic_phases.green_time_value(lightGreenTime), lightSummaries])
+    optimalLightWaitingStats = distributions[xmin]['lightWaitingStats']
+
+    results = {}
+    results['optimalGreenTime'] = traffic_phases.green_time_value(xmin) if isinstance(xmin, tuple) else float(xmin)
+    results['objective'] = objectiveWeights
+    results['objectiveValue'] = float(ymin)
+    # Still the plain mean when the objective is a percentile, so the results page always has it.
+    results['averageWaitingTime'] = float(traffic_stats.objective_value(optimalLightWaitingStats, {'mean': 1.0}))
+    results['distributions'] = distributionSummaries
+    results['curve'] = [[traffic_phases.green_time_value(lightGreenTime), float(averageWaitingTime)] for lightGreenTime, averageWaitingTime in dataArray]
+    results['oversaturatedGreenTimes'] = [traffic_phases.green_time_value(lightGreenTime) for lightGreenTime in oversaturatedGreenTimes]
+    results['optimalOversaturated'] = xmin in oversaturatedGreenTimes
+    if seed is not None:
+        results['seed'] = seed
+    if prescreenEstimates is not None:
+        results['prescreenEstimates'] = prescreenEstimates
+    if searchTrace is not None:
+        results['searchTrace'] = [[traffic_phases.green_time_value(lightGreenTime), averageWaitingTime, oversaturated] for lightGreenTime, averageWaitingTime, oversaturated in searchTrace]
+    if estimator == 'batchMeans':
+        results['batchMeansIntervals'] = [[traffic_phases.green_time_value(lightGreenTime)] + [float(value) for value in traffic_stats.confidence_interval(batchWaitingTimes)]
+                                          for lightGreenTime, batchWaitingTimes in sorted(settingWaitingTimes.items())]
+    results['iterationsUsed'] = [[traffic_phases.green_time_value(lightGreenTime), len(waitingTimes)] for lightGreenTime, waitingTimes in settingWaitingTimes.items()]
+    return results, dataArray
+
+def choose_seed(optData, required=False):
+    # Workers cannot share the clock based seeding and a search needs common random
+    # numbers to compare green times, so every task gets a seed derived from this one.
+    if optData.get('seed') is None and (required or int(optData.get('workers', 1)) > 1 or optData.get('search', 'grid') != 'grid'):
+        optData = dict(optData, seed=random.SystemRandom().randrange(2 ** 32))
+    return optData
+
+def results_path(resultsPath=None):
+    # Where the results page reads from, unless a job keeps its own results.
+    return resultsPath or os.path.join(CWD, 'TempData', 'optimisationResults.pkl')
+
+def run_optimisation(envData, optData, progress=None, executor=None, resultsPath=None):
+    """Find the best light green time, progress optionally receives every replication as it finishes.
+
+    executor is a process pool shared with other jobs, without one a pool of
+    optData's workers is made for this run. The results are pickled to resultsPath.
+    """
+    validate_options(optData, envData)
+    optData = choose_seed(optData)
+    workers = int(optData.get('workers', 1))
+    ownExecutor = executor is None and workers > 1
+    if ownExecutor:
+        executor = concurrent.futures.ProcessPoolExecutor(max_workers=workers)
+    try:
+        results, dataArray = optimise_green_time(envData, optData, progress, executor)
+    finally:
+        if ownExecutor:
+            executor.shutdown()
+    oversaturatedGreenTimes = results['oversaturatedGreenTimes']
 
     x, y = zip(*dataArray)
 
-    ymin = min(y)
-    xmin = x[y.index(ymin)]
     # xnew = np.linspace(np.array(x).min(), np.array(x).max(), 300)
 
     # spl = make_interp_spline(np.array(x), np.array(y), k=3)
     # ynew = spl(xnew)
-    plt.plot(x, y, color='g')
-    plt.xlabel('Light Green Time')
-    plt.ylabel('Average Waiting Time')
-    pltFileName = str(time.time()) + '.png'
+    if optData.get('search', 'grid') == 'pattern':
+        # A green split has no single axis, so the evaluations are drawn in the order the search made them.
+        points = [[evaluation, averageWaitingTime, oversaturated] for evaluation, (lightGreenTime, averageWaitingTime, oversaturated) in enumerate(results['searchTrace'], 1)]
+        xLabel = 'Search Evaluation'
+    else:
+        points = [[lightGreenTime, averageWaitingTime, lightGreenTime in oversaturatedGreenTimes] for lightGreenTime, averageWaitingTime in dataArray]
+        xLabel = 'Light Green Time'
+    # Oversaturated points are only lower bounds, so they are marked rather than joined up with the rest of the curve.
+    pltFileName = traffic_render.render_graph({'series': [{'points': [[float(x), float(y)] for x, y, oversaturated in points if not oversaturated], 'style': 'line'},
+                                                          {'points': [[float(x), float(y)] for x, y, oversaturated in points if oversaturated], 'style': 'markers',
+                                                           'label': 'Oversaturated (lower bound)'}],
+                                               'xLabel': xLabel,
+                                               'yLabel': 'Average Waiting Time' if results['objective'] == {'mean': 1.0} else 'Waiting Time Objective'},
+                                              os.path.join(CWD, 'static', 'images', 'graphImages'))
 
     resData = envData
-    resData['optimalGreenTime'] = float(xmin)
-    resData['averageWaitingTime'] = float(ymin)
+    resData.update(results)
     resData['graphFileName'] = pltFileName
-    with open(os.path.join(CWD, 'static', 'images', 'graphImages', pltFileName), 'wb+') as tempPltImgFile:
-        plt.savefig(tempPltImgFile)
-    with open(os.path.join(CWD, 'TempData', 'optimisationResults.pkl'), 'wb+s') as tempDataFile:
+    with open(results_path(resultsPath), 'wb+') as tempDataFile:
         pickle.dump(resData, tempDataFile, pickle.HIGHEST_PROTOCOL)
+    return resData
+
+def iterate_optimisation(envData, optData):
+    """Run the optimisation in a thread, yielding each replication update as it lands.
+
+    The last item yielded has event 'finished' and carries the results.
+    """
+    updates = queue.Queue()
+    outcome = {}
+
+    def optimise():
+        try:
+            outcome['results'] = run_optimisation(envData, optData, traffic_progress.OptimisationProgress(updates.put))
+        except Exception as error:
+            outcome['error'] = error
+        finally:
+            updates.put(None)
+
+    optimisationThread = threading.Thread(target=optimise, daemon=True)
+    optimisationThread.start()
+    while True:
+        update = updates.get()
+        if update is None:
+            break
+        yield update
+    optimisationThread.join()
+    if 'error' in outcome:
+        raise outcome['error']
+    yield {'event': 'finished', 'results': outcome['results']}
@@ -18,6 +18,10 @@ import pickle
 import time
 from sys import platform as _platform
 
+import traffic_arrivals
+import traffic_phases
+import traffic_stats
+
 if 'debian' in _platform:
     runningOnPi = True
     os.system('sudo pigpiod')
@@ -34,60 +38,75 @@ if runningOnPi:
 CWD = os.path.dirname(os.path.realpath(__file__))
 
 VIEWPORT_RESOLUTION = [2560,1600]
-PERCENTAGE_TIME_SAFETY_ADDITION = 0.2
+# Waiting times kept for the graph before it starts again.
+RECENT_WAITING_TIMES = 1000
+# Height of each light's row in the animation window.
+LIGHT_ROW_HEIGHT = 250
 STATE_COLOURS_DICT = {"states":[{"state":"red", "rgb":(255,0,0), "pin":[17]},{"state":"redamber","rgb":(255,191,0), "pin":[17, 27]},{"state":"green", "rgb":(0,255,0), "pin":[22]},{"state":"amber","rgb":(255,191,0), "pin":[27]}]}
 
 class VehicleSpawner(sim.Component):
 
-    def setup(self, trafficEnv):
+    def setup(self, trafficEnv, envData):
         self.trafficEnv = trafficEnv
         self.lightList = trafficEnv.lightList
-        self.randomUniform = sim.Uniform(0,1)
+        self.arrivalStreams = traffic_arrivals.arrival_streams(envData)
 
     def process(self):
         while True:
-            for light in self.lightList:
-                if light.busyness > self.randomUniform.sample():
+            now = self.env.now()
+            for light, arrivalStream in zip(self.lightList, self.arrivalStreams):
+                if arrivalStream.nextArrival <= now:
+                    arrivalStream.advance()
                     Vehicle(light=light, trafficEnv=self.trafficEnv)
-            yield self.hold(1)
+            nextArrival = min(arrivalStream.nextArrival for arrivalStream in self.arrivalStreams)
+            if nextArrival == float('inf'):
+                yield self.passivate()
+            yield self.hold(till=nextArrival)
 
 
 class TrafficManagement(sim.Component):
 
     def setup(self, trafficEnv):
         self.trafficEnv = trafficEnv
-        self.lightList = trafficEnv.lightList
-        self.timeLightGreen = trafficEnv.timeLightGreen
-        self.timeLtoLSafety = trafficEnv.timeLtoLSafety
+        self.phaseLights = [[trafficEnv.lightList[lightNum] for lightNum in phase] for phase in trafficEnv.phases]
+        self.phaseGreenTimes = trafficEnv.phaseGreenTimes
+        self.phaseClearanceTimes = trafficEnv.phaseClearanceTimes
 
     def process(self):
         while True:
-            for light in self.lightList:
-                yield self.hold(self.timeLtoLSafety)
-                light.change_state(state='amber')
-                yield self.hold(1)
-                light.change_state(state='green')
-                yield self.wait((light.movementState, 'none'), fail_delay=self.timeLightGreen)
-                light.change_state(state='amber')
-                yield self.hold(1)
-                light.change_state(state='red')
+            for lights, clearanceTime, greenTime in zip(self.phaseLights, self.phaseClearanceTimes, self.phaseGreenTimes):
+                yield self.hold(clearanceTime)
+                for light in lights:
+                    light.change_state(state='amber')
+                yield self.hold(traffic_phases.AMBER_TIME)
+                for light in lights:
+                    light.change_state(state='green')
+                yield self.wait(*[(light.movementState, 'none') for light in lights], all=True, fail_delay=greenTime)
+                for light in lights:
+                    light.change_state(state='amber')
+                yield self.hold(traffic_phases.AMBER_TIME)
+                for light in lights:
+                    light.change_state(state='red')
 
 
 class TrafficEnvironment():
 
     def __init__(self, envData, timeLightGreen):
         self.lightList = []
-        for lightNum in range(2):
-            self.lightList.append(Light(sensitivity=envData['lightData'][lightNum]['sensorSensitivity'], busyness=envData['lightData'][lightNum]['busyness']))
+        for lightData in envData['lightData']:
+            self.lightList.append(Light(sensitivity=lightData['sensorSensitivity'], busyness=lightData['busyness']))
         self.roadBetween = RoadBetween()
         self.distanceLtoL = envData['lightDistance']
         self.speed = envData['speed'] / 2.237
         self.timeLtoL = self.distanceLtoL / self.speed
-        self.timeLtoLSafety = self.timeLtoL * (1 + PERCENTAGE_TIME_SAFETY_ADDITION)
+        self.timeLtoLSafety = self.timeLtoL * (1 + traffic_phases.PERCENTAGE_TIME_SAFETY_ADDITION)
+        self.phases = traffic_phases.site_phases(envData)
+        self.phaseClearanceTimes = traffic_phases.phase_clearance_times(envData, self.phases)
         self.timeLightGreen = timeLightGreen
+        self.phaseGreenTimes = traffic_phases.phase_green_times(timeLightGreen, len(self.phases))
         self.timeUpQueue = envData['timeUpQueue']
 
-        self.vehicleSpawner = VehicleSpawner(trafficEnv=self)
+        self.vehicleSpawner = VehicleSpawner(trafficEnv=self, envData=envData)
         self.trafficManagement = TrafficManagement(trafficEnv=self)
 
 
@@ -95,32 +114,62 @@ class RoadBetween(sim.Component):
 
     def setup(self):
         self.vehiclesInBetweenBool = sim.State(
-            self.name() + ".vehiclesPresentState", value=False)
+            self.name() + ".vehiclesPresentState", value=False, monitor=False)
         self.vehiclesQueue = sim.Queue(
-            self.name() + ".vehiclesQueue")
+            self.name() + ".vehiclesQueue", monitor=False)
 
 
 class Light(sim.Component):
 
     def setup(self, sensitivity, busyness):
-        self.state = sim.State((self.name() + ".state"), value="red")
-        self.vehiclesQueue = sim.Queue(self.name() + ".queue")
+        self.state = sim.State((self.name() + ".state"), value="red", monitor=False)
+        # Salabim's queue monitors keep every sample, these keep a fixed size summary instead.
+        self.vehiclesQueue = sim.Queue(self.name() + ".queue", monitor=False)
+        self.waitingTimeStats = traffic_stats.StreamingStats()
+        self.queueLengthStats = traffic_stats.LevelStats(0, self.env.now())
+        # Only feeds the waiting time graph, cleared now and then so it cannot grow for ever.
+        self.recentWaitingTimes = sim.Monitor(self.name() + ".recentWaitingTimes")
         self.movementSensorSensitivity = sensitivity
-        self.movementState = sim.State(self.name() + ".movementState", value='movement')
+        self.movementState = sim.State(self.name() + ".movementState", value='movement', monitor=False)
         self.busyness = busyness
-
-    def process(self):
-        while True:
-            if self.movementSensorSensitivity == -1:
-                pass
-            else:
-                if len(self.vehiclesQueue) == 0:
-                    yield self.hold(self.movementSensorSensitivity)
-                    if len(self.vehiclesQueue) == 0:
-                        self.movementState.set('none')
-                elif len(self.vehiclesQueue) > 0:
-                    self.movementState.set('movement')
-            yield self.hold(0.1)
+        self.lastVehicle = None
+
+        if self.movementSensorSensitivity != -1:
+            self.activate(process='sensor_timer')
+
+    def sensor_timer(self):
+        yield self.hold(self.movementSensorSensitivity)
+        self.movementState.set('none')
+
+    def add_vehicle(self, vehicle):
+        self.vehiclesQueue.add(vehicle)
+        self.queueLengthStats.set(len(self.vehiclesQueue), self.env.now())
+        # Vehicles keep hold of their neighbours so nobody has to search the queue.
+        vehicle.vehicleInFront = self.lastVehicle
+        if self.lastVehicle is not None:
+            self.lastVehicle.vehicleBehind = vehicle
+        self.lastVehicle = vehicle
+        if self.movementSensorSensitivity != -1:
+            # A vehicle arriving disarms the sensor until the queue empties again.
+            if self.isscheduled():
+                self.cancel()
+            self.movementState.set('movement')
+
+    def remove_vehicle(self, vehicle):
+        waitingTime = self.env.now() - vehicle.enter_time(self.vehiclesQueue)
+        self.waitingTimeStats.add(waitingTime)
+        if self.recentWaitingTimes.number_of_entries() >= RECENT_WAITING_TIMES:
+            self.recentWaitingTimes.reset()
+        self.recentWaitingTimes.tally(waitingTime)
+        self.vehiclesQueue.remove(vehicle)
+        self.queueLengthStats.set(len(self.vehiclesQueue), self.env.now())
+        if vehicle.vehicleBehind is not None:
+            vehicle.vehicleBehind.vehicleInFront = None
+            vehicle.vehicleBehind = None
+        if self.lastVehicle is vehicle:
+            self.lastVehicle = None
+        if self.movementSensorSensitivity != -1 and len(self.vehiclesQueue) == 0:
+            self.activate(process='sensor_timer')
 
     def change_state(self, state):
         self.state.set(state)
@@ -132,33 +181,29 @@ class Vehicle(sim.Component):
         self.trafficEnv = trafficEnv
         self.roadBetween = trafficEnv.roadBetween
         self.atLight = light
-        self.movedState = sim.State(self.name() + ".movedState")
-        self.atLight.vehiclesQueue.add(self)
+        self.movedState = sim.State(self.name() + ".movedState", monitor=False)
+        self.vehicleInFront = None
+        self.vehicleBehind = None
+        self.atLight.add_vehicle(self)
 
     def process(self):
-        while True:
-            if self.atLight.vehiclesQueue.index(self) == 0:
-                yield self.wait((self.atLight.state, 'green'))
-                # Travelling Between Lights
-                self.roadBetween.vehiclesQueue.add(self)
-                self.roadBetween.vehiclesInBetweenBool.set(True)
-                self.atLight.vehiclesQueue.remove(self)
-                self.movedState.set()
-                yield self.hold(self.trafficEnv.timeLtoLSafety)
-                self.roadBetween.vehiclesQueue.remove(self)
-                if len(self.roadBetween.vehiclesQueue) == 0:
-                    self.roadBetween.vehiclesInBetweenBool.set(False)
-            elif self not in self.atLight.vehiclesQueue:
-                break
-            else:
-                vehicleInFront = self.atLight.vehiclesQueue[self.atLight.vehiclesQueue.index(self)-1]
-                yield self.wait(vehicleInFront.movedState)
-                # Moving Up Queue
-                yield self.hold(self.trafficEnv.timeUpQueue)
-                self.movedState.set()
-                yield self.hold(0.01)
-                self.movedState.set(False)
-                self.process()
+        while self.vehicleInFront is not None:
+            yield self.wait(self.vehicleInFront.movedState)
+            # Moving Up Queue
+            yield self.hold(self.trafficEnv.timeUpQueue)
+            self.movedState.set()
+            yield self.hold(traffic_phases.MOVED_PULSE_TIME)
+            self.movedState.set(False)
+        yield self.wait((self.atLight.state, 'green'))
+        # Travelling Between Lights
+        self.roadBetween.vehiclesQueue.add(self)
+        self.roadBetween.vehiclesInBetweenBool.set(True)
+        self.atLight.remove_vehicle(self)
+        self.movedState.set()
+        yield self.hold(self.trafficEnv.timeLtoLSafety)
+        self.roadBetween.vehiclesQueue.remove(self)
+        if len(self.roadBetween.vehiclesQueue) == 0:
+            self.roadBetween.vehiclesInBetweenBool.set(False)
 
 
 def check_light_state(light, state, updateRealLight):
@@ -180,42 +225,31 @@ def check_light_state(light, state, updateRealLight):
                 return stateDict["rgb"]+tuple([60])
 
 def setup_animation_window(trafficEnv, env):
+    # Light rows are stacked down from the title, the window grows to fit them.
+    titleTop = LIGHT_ROW_HEIGHT * len(trafficEnv.lightList) + 228
+    env.animation_parameters(height=titleTop + 40)
     env.background_color('90%gray')
-    sim.AnimateText(text="Traffic Environment Simulation", x=10, y=728, textcolor='20%gray', fontsize=30)
-
-    # Animation setup for Light A
-    sim.AnimateText(text="Light A", x=10, y=700, textcolor='20%gray', fontsize=20)
-    sim.AnimateRectangle(spec=(10, 530, 70, 690), fillcolor='black')
-    sim.AnimateCircle(radius=20, x=40, y=660, fillcolor=lambda: check_light_state(trafficEnv.lightList[0], 'red', True))
-    sim.AnimateCircle(radius=20, x=40, y=610, fillcolor=lambda: check_light_state(trafficEnv.lightList[0], 'amber', True))
-    sim.AnimateCircle(radius=20, x=40, y=560, fillcolor=lambda: check_light_state(trafficEnv.lightList[0], 'green', True))
-    sim.AnimateRectangle(spec=(83,650,786,714), linecolor='90%gray', linewidth=2, fillcolor='whitesmoke')
-    sim.AnimateQueue(trafficEnv.lightList[0].vehiclesQueue, x=110, y=674, title='Queue', direction='e', max_length=14)
-    sim.AnimateRectangle(spec=(83,525,786,646), linecolor='90%gray', linewidth=2, fillcolor='whitesmoke')
-    sim.AnimateMonitor(trafficEnv.lightList[0].vehiclesQueue.length_of_stay, title="Waiting Time", x=90, y=530, width=689, height=100, horizontal_scale=2, vertical_scale=1)
-    sim.AnimateRectangle(spec=(790,525,1024,714), fillcolor='whitesmoke')
-    sim.AnimateText(text=lambda: "Queue Length: " + str(len(trafficEnv.lightList[0].vehiclesQueue)), x=795, y=694, fontsize=15, textcolor='20%gray')
-    sim.AnimateText(text=lambda: "Queue Length Mean: " + str(round(trafficEnv.lightList[0].vehiclesQueue.length.mean(), 1)), x=795, y=679, fontsize=15, textcolor='20%gray')
-    sim.AnimateText(text=lambda: "Queue Length Maximum: " + str(round(trafficEnv.lightList[0].vehiclesQueue.length.maximum(), 1)), x=795, y=664, fontsize=15, textcolor='20%gray')
-    sim.AnimateText(text=lambda: "Waiting Time Mean: " + str(round(trafficEnv.lightList[0].vehiclesQueue.length_of_stay.mean(), 1)), x=795, y=634, fontsize=15, textcolor='20%gray')
-    sim.AnimateText(text=lambda: "Waiting Time Maximum: " + str(round(trafficEnv.lightList[0].vehiclesQueue.length_of_stay.maximum(), 1)), x=795, y=619, fontsize=15, textcolor='20%gray')
-
-    # Animation setup for Light B.
-    sim.AnimateText(text="Light B", x=10, y=450, textcolor='20%gray', fontsize=20)
-    sim.AnimateRectangle(spec=(10, 280, 70, 440), fillcolor='black')
-    sim.AnimateCircle(radius=20, x=40, y=410, fillcolor=lambda: check_light_state(trafficEnv.lightList[1], 'red', False))
-    sim.AnimateCircle(radius=20, x=40, y=360, fillcolor=lambda: check_light_state(trafficEnv.lightList[1], 'amber', False))
-    sim.AnimateCircle(radius=20, x=40, y=310, fillcolor=lambda: check_light_state(trafficEnv.lightList[1], 'green', False))
-    sim.AnimateRectangle(spec=(83,400,786,464), linecolor='90%gray', linewidth=2, fillcolor='whitesmoke')
-    sim.AnimateQueue(trafficEnv.lightList[1].vehiclesQueue, x=110, y=424, title='Queue', direction='e', max_length=14)
-    sim.AnimateRectangle(spec=(83,275,786,396), linecolor='90%gray', linewidth=2, fillcolor='whitesmoke')
-    sim.AnimateMonitor(trafficEnv.lightList[1].vehiclesQueue.length_of_stay, title="Waiting Time", x=90, y=280, width=689, height=100, horizontal_scale=2, vertical_scale=1)
-    sim.AnimateRectangle(spec=(790,275,1024,464), fillcolor='whitesmoke')
-    sim.AnimateText(text=lambda: "Queue Length: " + str(len(trafficEnv.lightList[1].vehiclesQueue)), x=795, y=444, fontsize=15, textcolor='20%gray')
-    sim.AnimateText(text=lambda: "Queue Length Mean: " + str(round(trafficEnv.lightList[1].vehiclesQueue.length.mean(), 1)), x=795, y=429, fontsize=15, textcolor='20%gray')
-    sim.AnimateText(text=lambda: "Queue Length Maximum: " + str(round(trafficEnv.lightList[1].vehiclesQueue.length.maximum(), 1)), x=795, y=414, fontsize=15, textcolor='20%gray')
-    sim.AnimateText(text=lambda: "Waiting Time Mean: " + str(round(trafficEnv.lightList[1].vehiclesQueue.length_of_stay.mean(), 1)), x=795, y=384, fontsize=15, textcolor='20%gray')
-    sim.AnimateText(text=lambda: "Waiting Time Maximum: " + str(round(trafficEnv.lightList[1].vehiclesQueue.length_of_stay.maximum(), 1)), x=795, y=369, fontsize=15, textcolor='20%gray')
+    sim.AnimateText(text="Traffic Environment Simulation", x=10, y=titleTop, textcolor='20%gray', fontsize=30)
+    for lightNum, light in enumerate(trafficEnv.lightList):
+        # Only the first light drives the real light.
+        setup_light_animation(light, env, chr(ord('A') + lightNum), titleTop - 28 - LIGHT_ROW_HEIGHT * lightNum, lightNum == 0)
+
+def setup_light_animation(light, env, lightName, top, updateRealLight):
+    sim.AnimateText(text="Light " + lightName, x=10, y=top, textcolor='20%gray', fontsize=20)
+    sim.AnimateRectangle(spec=(10, top - 170, 70, top - 10), fillcolor='black')
+    sim.AnimateCircle(radius=20, x=40, y=top - 40, fillcolor=lambda: check_light_state(light, 'red', updateRealLight))
+    sim.AnimateCircle(radius=20, x=40, y=top - 90, fillcolor=lambda: check_light_state(light, 'amber', updateRealLight))
+    sim.AnimateCircle(radius=20, x=40, y=top - 140, fillcolor=lambda: check_light_state(light, 'green', updateRealLight))
+    sim.AnimateRectangle(spec=(83, top - 50, 786, top + 14), linecolor='90%gray', linewidth=2, fillcolor='whitesmoke')
+    sim.AnimateQueue(light.vehiclesQueue, x=110, y=top - 26, title='Queue', direction='e', max_length=14)
+    sim.AnimateRectangle(spec=(83, top - 175, 786, top - 54), linecolor='90%gray', linewidth=2, fillcolor='whitesmoke')
+    sim.AnimateMonitor(light.recentWaitingTimes, title="Waiting Time", x=90, y=top - 170, width=689, height=100, horizontal_scale=2, vertical_scale=1)
+    sim.AnimateRectangle(spec=(790, top - 175, 1024, top + 14), fillcolor='whitesmoke')
+    sim.AnimateText(text=lambda: "Queue Length: " + str(len(light.vehiclesQueue)), x=795, y=top - 6, fontsize=15, textcolor='20%gray')
+    sim.AnimateText(text=lambda: "Queue Length Mean: " + str(round(light.queueLengthStats.until(env.now()).mean, 1)), x=795, y=top - 21, fontsize=15, textcolor='20%gray')
+    sim.AnimateText(text=lambda: "Queue Length Maximum: " + str(round(light.queueLengthStats.until(env.now()).maximum, 1)), x=795, y=top - 36, fontsize=15, textcolor='20%gray')
+    sim.AnimateText(text=lambda: "Waiting Time Mean: " + str(round(light.waitingTimeStats.mean, 1)), x=795, y=top - 66, fontsize=15, textcolor='20%gray')
+    sim.AnimateText(text=lambda: "Waiting Time Maximum: " + str(round(light.waitingTimeStats.maximum, 1)), x=795, y=top - 81, fontsize=15, textcolor='20%gray')
 
 def run_simulation(resData):
     env = sim.Environment(trace=False, random_seed=time.time())
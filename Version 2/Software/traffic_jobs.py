@@ -0,0 +1,265 @@
+"""Queue of optimisation jobs shared by everyone using the web app.
+
+Every submission becomes a Job with its own id, progress and results file, so
+runs submitted at the same time never see each other's results. A few driver
+threads take jobs off a bounded queue in turn and run them, all of them
+handing their replications to the one process pool so the machine is never
+asked for more worker processes than it has.
+
+Author: Edward Upton (engiego)
+        Ben Dodd (mitgobla)
+"""
+
+import collections
+import concurrent.futures
+import concurrent.futures.process
+import math
+import os
+import pickle
+import queue
+import threading
+import time
+import traceback
+import uuid
+
+import traffic_corridor
+import traffic_demand
+import traffic_env_optimising
+import traffic_phases
+import traffic_plan
+import traffic_progress
+
+JOB_DIRECTORY = os.path.join(traffic_env_optimising.CWD, 'TempData', 'jobs')
+# Jobs that can wait for a driver thread before submissions are turned away, a waiting job is only its settings.
+JOB_QUEUE_SIZE = 256
+# Most scenarios one submission can hold, however much room the queue has at the time.
+JOB_BATCH_SIZE = 256
+# Jobs run at the same time, their replications interleave on the process pool.
+JOB_CONCURRENCY = 2
+# Finished jobs remembered, older ones are forgotten and their results deleted. Enough
+# for a full queue's results to still be there once the last of them has finished.
+JOB_HISTORY = 2 * JOB_QUEUE_SIZE
+JOB_KINDS = ['optimisation', 'plan', 'corridor']
+# Kinds of job for a single site, the ones the results pages can show.
+SITE_JOB_KINDS = ['optimisation', 'plan']
+# Settings a job cannot be run without, the rest have defaults.
+ENV_DATA_KEYS = ['lightDistance', 'speed', 'timeUpQueue', 'lightData']
+LIGHT_DATA_KEYS = ['busyness', 'sensorSensitivity']
+OPT_DATA_KEYS = ['envTime', 'lightGreenTimeRange', 'lightGreenTimeStep', 'iterationsPerSetting']
+CORRIDOR_OPT_DATA_KEYS = ['envTime', 'iterationsPerSetting', 'siteGreenTimes']
+# Results of each kind of job small enough to send with its status.
+JOB_SUMMARY_KEYS = ['optimalGreenTime', 'optimalOffsets', 'objectiveValue', 'averageWaitingTime', 'optimalOversaturated',
+                    'unoffsetObjectiveValue', 'periodCount', 'demandCount', 'seed']
+
+
+class JobQueueFull(Exception):
+    pass
+
+
+class Job():
+    """One submitted optimisation, plan or corridor run and its state."""
+
+    def __init__(self, kind, envData, optData):
+        self.jobId = uuid.uuid4().hex
+        self.kind = kind
+        self.envData = envData
+        self.optData = optData
+        self.progress = traffic_progress.OptimisationProgress()
+        self.status = 'queued'
+        self.error = None
+        self.submittedTime = time.time()
+        self.startedTime = None
+        self.finishedTime = None
+        self.resultsPath = os.path.join(JOB_DIRECTORY, self.jobId + '.pkl')
+
+    def run(self, executor, workers):
+        # The pool is the server's, so the job's workers is whatever it was started with.
+        optData = dict(self.optData, workers=workers)
+        if self.kind == 'plan':
+            traffic_plan.run_plan(self.envData, optData, self.progress, executor, self.resultsPath)
+        elif self.kind == 'corridor':
+            traffic_corridor.run_corridor_optimisation(self.envData, optData, self.progress, executor, self.resultsPath)
+        else:
+            traffic_env_optimising.run_optimisation(self.envData, optData, self.progress, executor, self.resultsPath)
+
+    def results(self):
+        """The results the job pickled, None until it has finished."""
+        if self.status != 'finished':
+            return None
+        with open(self.resultsPath, 'rb') as resultsFile:
+            return pickle.load(resultsFile)
+
+    def summary(self):
+        """The headline results of a finished job, None until then."""
+        results = self.results()
+        if results is None:
+            return None
+        return json_ready({key: results[key] for key in JOB_SUMMARY_KEYS if key in results})
+
+    def status_data(self):
+        return {'jobId': self.jobId,
+                'kind': self.kind,
+                'status': self.status,
+                'error': self.error,
+                'submittedTime': self.submittedTime,
+                'startedTime': self.startedTime,
+                'finishedTime': self.finishedTime}
+
+
+def json_ready(value):
+    """value with tuples as lists, numpy scalars as Python ones and NaN or infinity as None, so it can be sent as JSON."""
+    if isinstance(value, dict):
+        return {key if isinstance(key, str) else str(key): json_ready(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [json_ready(item) for item in value]
+    if hasattr(value, 'item'):
+        value = value.item()
+    if isinstance(value, float) and not math.isfinite(value):
+        return None
+    return value
+
+
+def missing_keys(data, keys, name):
+    if not isinstance(data, dict):
+        raise ValueError(name + " has to be an object")
+    missing = [key for key in keys if key not in data]
+    if missing:
+        raise ValueError(name + " is missing " + ", ".join(missing))
+
+
+def validate_site(envData, name):
+    missing_keys(envData, ENV_DATA_KEYS, name)
+    if not isinstance(envData['lightData'], list) or len(envData['lightData']) < 2:
+        raise ValueError(name + " needs a lightData list with at least two lights")
+    for lightNum, lightData in enumerate(envData['lightData']):
+        missing_keys(lightData, LIGHT_DATA_KEYS, name + " light " + str(lightNum))
+    traffic_phases.site_phases(envData)
+    traffic_demand.demand_periods(envData)
+
+
+def validate_job(kind, envData, optData):
+    """Raises ValueError for a job that could not run, before it takes a place in the queue."""
+    if kind not in JOB_KINDS:
+        raise ValueError("Unknown job kind: " + str(kind))
+    if kind == 'corridor':
+        missing_keys(envData, ['sites'], "corridorData")
+        for siteNum, siteData in enumerate(envData['sites']):
+            validate_site(siteData, "Site " + str(siteNum))
+        traffic_corridor.corridor_links(envData)
+        missing_keys(optData, CORRIDOR_OPT_DATA_KEYS, "optData")
+    else:
+        validate_site(envData, "envData")
+        missing_keys(optData, OPT_DATA_KEYS, "optData")
+        traffic_env_optimising.validate_options(optData, envData)
+
+
+class JobQueue():
+    """Bounded queue of jobs run by concurrency driver threads on one pool of workers processes."""
+
+    def __init__(self, workers=os.cpu_count() or 1, concurrency=JOB_CONCURRENCY, maxQueued=JOB_QUEUE_SIZE, history=JOB_HISTORY):
+        self.workers = int(workers)
+        self.history = int(history)
+        self.executor = self.new_executor()
+        self.waiting = queue.Queue(maxsize=int(maxQueued))
+        self.jobs = collections.OrderedDict()
+        self.lock = threading.Lock()
+        os.makedirs(JOB_DIRECTORY, exist_ok=True)
+        for driverNum in range(int(concurrency)):
+            threading.Thread(target=self.drive, name="jobDriver" + str(driverNum), daemon=True).start()
+
+    def new_executor(self):
+        return concurrent.futures.ProcessPoolExecutor(max_workers=self.workers) if self.workers > 1 else None
+
+    def submit(self, kind, envData, optData):
+        """Queue a job and return it, raises ValueError for bad options and JobQueueFull when there is no room."""
+        return self.submit_many([(kind, envData, optData)])[0]
+
+    def submit_many(self, scenarios, partial=False):
+        """Queue a job for each (kind, envData, optData) and return the jobs queued.
+
+        Every scenario is checked first, ValueError for any that could not run. When
+        the queue has no room for them all JobQueueFull is raised and none are queued,
+        unless partial, when as many as fit are queued in order and the rest are not.
+        """
+        if len(scenarios) > JOB_BATCH_SIZE:
+            raise ValueError("At most " + str(JOB_BATCH_SIZE) + " scenarios can be submitted together, got " + str(len(scenarios)))
+        for scenarioNum, (kind, envData, optData) in enumerate(scenarios):
+            try:
+                validate_job(kind, envData, optData)
+            except ValueError as error:
+                raise ValueError(str(error) if len(scenarios) == 1 else "Scenario " + str(scenarioNum) + ": " + str(error))
+        jobs = [Job(kind, envData, optData) for kind, envData, optData in scenarios]
+        with self.lock:
+            # Only submissions add to the queue and they hold the lock, so the room cannot shrink before the jobs are put.
+            room = max(self.waiting.maxsize - self.waiting.qsize(), 0)
+            if room < len(jobs) and not (partial and room > 0):
+                raise JobQueueFull("The job queue only has room for " + str(room) + " more jobs, try again later")
+            jobs = jobs[:room]
+            for job in jobs:
+                self.waiting.put_nowait(job)
+                self.jobs[job.jobId] = job
+            self.forget_old_jobs()
+        return jobs
+
+    def get(self, jobId):
+        with self.lock:
+            return self.jobs.get(jobId)
+
+    def all_jobs(self):
+        with self.lock:
+            return list(self.jobs.values())
+
+    def latest_job(self, kinds=None, status=None):
+        """The most recently submitted job of one of kinds with status, None when there is not one."""
+        for job in reversed(self.all_jobs()):
+            if (kinds is None or job.kind in kinds) and (status is None or job.status == status):
+                return job
+        return None
+
+    def queue_position(self, job):
+        """Jobs queued ahead of job plus one, 0 once it has left the queue."""
+        if job.status != 'queued':
+            return 0
+        queuedJobs = [queuedJob for queuedJob in self.all_jobs() if queuedJob.status == 'queued']
+        return queuedJobs.index(job) + 1 if job in queuedJobs else 0
+
+    def forget_old_jobs(self):
+        # Called holding the lock, only finished and failed jobs are forgotten.
+        doneJobIds = [jobId for jobId, job in self.jobs.items() if job.status in ('finished', 'failed')]
+        for jobId in doneJobIds[:max(len(doneJobIds) - self.history, 0)]:
+            job = self.jobs.pop(jobId)
+            if os.path.exists(job.resultsPath):
+                os.remove(job.resultsPath)
+
+    def drive(self):
+        while True:
+            job = self.waiting.get()
+            job.status = 'running'
+            job.startedTime = time.time()
+            job.progress.touch()
+            with self.lock:
+                executor = self.executor
+            try:
+                job.run(executor, self.workers)
+                job.status = 'finished'
+            except concurrent.futures.process.BrokenProcessPool as error:
+                # A worker process died, every job using the pool has failed but later ones get a new pool.
+                job.error = str(error) or "A worker process died"
+                job.status = 'failed'
+                with self.lock:
+                    if self.executor is executor:
+                        executor.shutdown(wait=False)
+                        self.executor = self.new_executor()
+            except Exception as error:
+                traceback.print_exc()
+                job.error = str(error)
+                job.status = 'failed'
+            job.finishedTime = time.time()
+            job.progress.touch()
+            self.waiting.task_done()
+            with self.lock:
+                self.forget_old_jobs()
+
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown()
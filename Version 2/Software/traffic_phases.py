@@ -0,0 +1,97 @@
+"""Phases and clearance times of an N approach site.
+
+Every light is one approach. envData's optional clearanceTimes matrix gives
+the seconds of all red approach i's traffic needs to clear the site before
+approach j can go, None where the two approaches do not conflict and can be
+green together. Without it every approach conflicts with every other and needs
+the shuttle's time to drive between the lights.
+
+Approaches that can run together are grouped into phases, given as
+envData['phases'] or grouped in approach order, and the phases run in turn.
+A green time is either one time for every phase or a list with one per phase.
+
+Author: Edward Upton (engiego)
+        Ben Dodd (mitgobla)
+"""
+
+# Every engine runs the same model from these, so their seeded results agree.
+PERCENTAGE_TIME_SAFETY_ADDITION = 0.2
+AMBER_TIME = 1
+# A vehicle signals it has moved up the queue for this long.
+MOVED_PULSE_TIME = 0.01
+
+
+def shuttle_clearance_time(envData):
+    # Time to drive between the lights plus a safety margin.
+    speed = envData['speed'] / 2.237
+    return envData['lightDistance'] / speed * (1 + PERCENTAGE_TIME_SAFETY_ADDITION)
+
+
+def clearance_matrix(envData):
+    lightCount = len(envData['lightData'])
+    clearanceTimes = envData.get('clearanceTimes')
+    if clearanceTimes is None:
+        clearanceTime = shuttle_clearance_time(envData)
+        return [[None if fromNum == toNum else clearanceTime for toNum in range(lightCount)] for fromNum in range(lightCount)]
+    if len(clearanceTimes) != lightCount or any(len(row) != lightCount for row in clearanceTimes):
+        raise ValueError("Clearance times need a row and a column for each of the " + str(lightCount) + " approaches")
+    return [[None if clearanceTime is None or fromNum == toNum else float(clearanceTime) for toNum, clearanceTime in enumerate(row)]
+            for fromNum, row in enumerate(clearanceTimes)]
+
+
+def conflicting(clearanceTimes, firstNum, secondNum):
+    return clearanceTimes[firstNum][secondNum] is not None or clearanceTimes[secondNum][firstNum] is not None
+
+
+def site_phases(envData):
+    """The approaches of each phase, in the order they run."""
+    lightCount = len(envData['lightData'])
+    clearanceTimes = clearance_matrix(envData)
+    phases = envData.get('phases')
+    if phases is None:
+        # Each approach joins the first phase it does not conflict with.
+        phases = []
+        for lightNum in range(lightCount):
+            for phase in phases:
+                if not any(conflicting(clearanceTimes, lightNum, phaseLightNum) for phaseLightNum in phase):
+                    phase.append(lightNum)
+                    break
+            else:
+                phases.append([lightNum])
+    phases = [tuple(int(lightNum) for lightNum in phase) for phase in phases]
+    if sorted(lightNum for phase in phases for lightNum in phase) != list(range(lightCount)):
+        raise ValueError("Every approach has to be in exactly one phase")
+    for phase in phases:
+        for firstNum in phase:
+            for secondNum in phase:
+                if firstNum != secondNum and conflicting(clearanceTimes, firstNum, secondNum):
+                    raise ValueError("Approaches " + str(firstNum + 1) + " and " + str(secondNum + 1) + " conflict so cannot share a phase")
+    return phases
+
+
+def phase_clearance_times(envData, phases):
+    """All red time before each phase, long enough for every conflicting approach of the phase before to clear."""
+    clearanceTimes = clearance_matrix(envData)
+    return [max([clearanceTimes[fromNum][toNum] for fromNum in previousPhase for toNum in phase if clearanceTimes[fromNum][toNum] is not None], default=0.0)
+            for previousPhase, phase in zip(phases[-1:] + phases[:-1], phases)]
+
+
+def phase_green_times(timeLightGreen, phaseCount):
+    """One green time per phase from a single green time or a green split."""
+    if isinstance(timeLightGreen, (list, tuple)):
+        if len(timeLightGreen) != phaseCount:
+            raise ValueError("A green split needs one green time for each of the " + str(phaseCount) + " phases")
+        return list(timeLightGreen)
+    return [timeLightGreen] * phaseCount
+
+
+def cycle_time(envData, lightGreenTime):
+    """Longest a cycle of the site takes, sensors can only end greens early."""
+    phases = site_phases(envData)
+    return sum(clearanceTime + 2 * AMBER_TIME + greenTime
+               for clearanceTime, greenTime in zip(phase_clearance_times(envData, phases), phase_green_times(lightGreenTime, len(phases))))
+
+
+def green_time_value(lightGreenTime):
+    # A green split is kept as a tuple so it can be a dict key, but is reported as a list.
+    return [float(phaseGreenTime) for phaseGreenTime in lightGreenTime] if isinstance(lightGreenTime, (list, tuple)) else lightGreenTime
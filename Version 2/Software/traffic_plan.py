@@ -0,0 +1,100 @@
+"""Whole day signal plans.
+
+The day is split into periods wherever a light's demand profile changes and
+the best green time is found for each period, treating its demand as steady
+for envTime simulated seconds. Periods whose demand rounds to the same
+busyness are only optimised once, and the distinct demands are optimised side
+by side on one shared process pool. The green times are put together into a
+timetable for the day.
+
+Author: Edward Upton (engiego)
+        Ben Dodd (mitgobla)
+"""
+
+import concurrent.futures
+import os
+import pickle
+
+import traffic_demand
+import traffic_env_optimising
+import traffic_render
+
+# Busyness step periods are rounded to before they are compared.
+PLAN_DEMAND_RESOLUTION = 0.01
+
+
+def period_env_data(envData, busyness):
+    # The environment of one period, every light at the period's steady busyness.
+    periodEnvData = dict(envData)
+    periodEnvData['lightData'] = []
+    for lightData, lightBusyness in zip(envData['lightData'], busyness):
+        periodLightData = {key: value for key, value in lightData.items() if key != 'demandProfile'}
+        periodLightData['busyness'] = lightBusyness
+        periodEnvData['lightData'].append(periodLightData)
+    return periodEnvData
+
+
+def optimise_demands(envData, optData, demands, progress=None, executor=None):
+    """The optimisation results of each distinct demand, keyed by its busyness."""
+    workers = int(optData.get('workers', 1))
+    if executor is None and workers <= 1:
+        return {demand: traffic_env_optimising.optimise_green_time(period_env_data(envData, demand), optData, progress)[0] for demand in demands}
+    # A thread drives each demand's search while they all share the one process pool.
+    ownExecutor = executor is None
+    if ownExecutor:
+        executor = concurrent.futures.ProcessPoolExecutor(max_workers=workers)
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(demands)) as demandExecutor:
+            futures = {demand: demandExecutor.submit(traffic_env_optimising.optimise_green_time, period_env_data(envData, demand), optData, progress, executor)
+                       for demand in demands}
+            return {demand: future.result()[0] for demand, future in futures.items()}
+    finally:
+        if ownExecutor:
+            executor.shutdown()
+
+
+def run_plan(envData, optData, progress=None, executor=None, resultsPath=None):
+    """Find the best light green time for every demand period of the day.
+
+    progress is shared by every period, so it counts the replications of the whole plan.
+    executor and resultsPath are as for run_optimisation.
+    """
+    traffic_env_optimising.validate_options(optData, envData)
+    # Periods are only comparable, and their results only reusable, with common random numbers.
+    optData = traffic_env_optimising.choose_seed(optData, required=True)
+    resolution = float(optData.get('planDemandResolution', PLAN_DEMAND_RESOLUTION))
+    periods = traffic_demand.demand_periods(envData)
+    periodDemands = [traffic_demand.round_demand(busyness, resolution) for start, end, busyness in periods]
+    demands = list(dict.fromkeys(periodDemands))
+    print("Plan has", len(periods), "periods and", len(demands), "distinct demands")
+    demandResults = optimise_demands(envData, optData, demands, progress, executor)
+
+    plan = []
+    for (start, end, busyness), demand in zip(periods, periodDemands):
+        results = demandResults[demand]
+        plan.append({'start': start,
+                     'end': end,
+                     'busyness': busyness,
+                     'simulatedBusyness': list(demand),
+                     'optimalGreenTime': results['optimalGreenTime'],
+                     'objectiveValue': results['objectiveValue'],
+                     'averageWaitingTime': results['averageWaitingTime'],
+                     'optimalOversaturated': results['optimalOversaturated'],
+                     'curve': results['curve']})
+
+    stepPoints = [[period['start'], period['optimalGreenTime']] for period in plan] + [[plan[-1]['end'], plan[-1]['optimalGreenTime']]]
+    pltFileName = traffic_render.render_graph({'series': [{'points': stepPoints, 'style': 'step'}],
+                                               'xLimits': [0, traffic_demand.HOURS_IN_DAY],
+                                               'xLabel': 'Hour of Day',
+                                               'yLabel': 'Light Green Time'},
+                                              os.path.join(traffic_env_optimising.CWD, 'static', 'images', 'graphImages'))
+
+    resData = envData
+    resData['plan'] = plan
+    resData['seed'] = optData['seed']
+    resData['periodCount'] = len(periods)
+    resData['demandCount'] = len(demands)
+    resData['graphFileName'] = pltFileName
+    with open(traffic_env_optimising.results_path(resultsPath), 'wb+') as tempDataFile:
+        pickle.dump(resData, tempDataFile, pickle.HIGHEST_PROTOCOL)
+    return resData
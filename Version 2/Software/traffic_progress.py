@@ -0,0 +1,84 @@
+"""Live progress of an optimisation run.
+
+Author: Edward Upton (engiego)
+        Ben Dodd (mitgobla)
+"""
+
+import threading
+import time
+
+
+class OptimisationProgress():
+    """Counts finished replications and passes each one to callback as soon as it lands.
+
+    The optimiser calls expect before it queues work, so the ETA is for the work
+    queued so far. Searches and adaptive runs queue more as they go. version
+    counts the changes, so watchers can wait for the next one instead of polling.
+    """
+
+    def __init__(self, callback=None):
+        self.callback = callback
+        self.lock = threading.Lock()
+        self.changed = threading.Condition(self.lock)
+        self.version = 0
+        self.startTime = time.perf_counter()
+        self.queued = 0
+        self.completed = 0
+        self.simulated = 0
+        # Running total and count of the waiting times of each green time, the partial curve.
+        self.settingTotals = {}
+
+    def expect(self, count):
+        with self.lock:
+            self.queued += count
+
+    def replication_done(self, lightGreenTime, iteration, averageWaitingTime, cached=False, oversaturated=False):
+        with self.lock:
+            self.completed += 1
+            if not cached:
+                self.simulated += 1
+            settingTotal = self.settingTotals.setdefault(lightGreenTime, [0.0, 0])
+            settingTotal[0] += averageWaitingTime
+            settingTotal[1] += 1
+            self.version += 1
+            self.changed.notify_all()
+            update = self.status()
+            update.update({'event': 'replication',
+                           'lightGreenTime': lightGreenTime,
+                           'iteration': iteration,
+                           'averageWaitingTime': averageWaitingTime,
+                           'cached': cached,
+                           'oversaturated': oversaturated,
+                           'settingAverageWaitingTime': settingTotal[0] / settingTotal[1]})
+        if self.callback is not None:
+            self.callback(update)
+
+    def touch(self):
+        # Something watchers show besides the replications has changed, such as the job finishing.
+        with self.lock:
+            self.version += 1
+            self.changed.notify_all()
+
+    def wait(self, version, timeout=None):
+        """Block until the version is no longer version or timeout seconds pass, returns the version then."""
+        with self.lock:
+            self.changed.wait_for(lambda: self.version != version, timeout)
+            return self.version
+
+    def status(self):
+        # Only simulated replications count towards throughput, cached ones take no time.
+        elapsed = time.perf_counter() - self.startTime
+        throughput = self.simulated / elapsed if elapsed > 0 else 0.0
+        remaining = max(self.queued - self.completed, 0)
+        return {'elapsed': elapsed,
+                'completed': self.completed,
+                'queued': self.queued,
+                'throughput': throughput,
+                'eta': remaining / throughput if throughput > 0 else None}
+
+    def snapshot(self):
+        """Status and the partial curve of [green time, average waiting time, replications] so far."""
+        with self.lock:
+            snapshot = self.status()
+            snapshot['curve'] = [[lightGreenTime, total / count, count] for lightGreenTime, (total, count) in sorted(self.settingTotals.items())]
+        return snapshot
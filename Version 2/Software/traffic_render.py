@@ -0,0 +1,114 @@
+"""Headless rendering of result graphs.
+
+Each graph is drawn on a figure of its own with the Agg canvas, never through
+pyplot's process wide state, and always on the one render thread so jobs that
+finish together are drawn in turn. An image is named by the hash of what it
+shows, so a graph that has been drawn before is reused rather than drawn and
+stored again. The modification time of an image is its last use, images older
+than GRAPH_MAX_AGE are removed and then the least recently used ones until
+the images fit in GRAPH_MAX_BYTES.
+
+A graph is a dict of its 'series', each with 'points', a 'style' of 'line',
+'step' or 'markers' and an optional 'label', and optional 'xLabel', 'yLabel'
+and 'xLimits'.
+
+Author: Edward Upton (engiego)
+        Ben Dodd (mitgobla)
+"""
+
+import concurrent.futures
+import io
+import os
+import re
+import time
+
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+
+import traffic_cache
+
+CWD = os.path.dirname(os.path.realpath(__file__))
+
+GRAPH_DIRECTORY = os.path.join(CWD, 'static', 'images', 'graphImages')
+GRAPH_MAX_BYTES = 20 * 1024 * 1024
+GRAPH_MAX_AGE = 7 * 24 * 60 * 60
+# Part of every image's hash, so changing how graphs are drawn never reuses an old image.
+RENDER_FORMAT = 1
+# Only rendered images are evicted, anything else in the directory is left alone.
+GRAPH_FILE_NAME = re.compile(r'^[0-9a-f]{64}\.png$')
+
+SERIES_STYLES = {'line': {'color': 'g'},
+                 'step': {'color': 'g', 'where': 'post'},
+                 'markers': {'color': 'r', 'marker': 'x', 'linestyle': 'none'}}
+
+renderExecutor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix='render')
+
+
+def draw_graph(graph):
+    """PNG bytes of graph."""
+    figure = Figure()
+    FigureCanvasAgg(figure)
+    axes = figure.add_subplot()
+    for series in graph['series']:
+        if not series['points']:
+            continue
+        x, y = zip(*series['points'])
+        draw = axes.step if series['style'] == 'step' else axes.plot
+        draw(x, y, label=series.get('label'), **SERIES_STYLES[series['style']])
+    if any(series.get('label') and series['points'] for series in graph['series']):
+        axes.legend()
+    if graph.get('xLimits') is not None:
+        axes.set_xlim(*graph['xLimits'])
+    axes.set_xlabel(graph.get('xLabel', ''))
+    axes.set_ylabel(graph.get('yLabel', ''))
+    image = io.BytesIO()
+    figure.savefig(image, format='png')
+    return image.getvalue()
+
+
+def store_graph(graph, path, directory):
+    # Runs on the render thread.
+    if os.path.exists(path):
+        os.utime(path)
+    else:
+        # Written next to the final name first so the page never shows half an image.
+        tempPath = path + '.tmp'
+        with open(tempPath, 'wb+') as imageFile:
+            imageFile.write(draw_graph(graph))
+        os.replace(tempPath, path)
+    evict_graphs(directory, keep=path)
+
+
+def render_graph(graph, directory=None):
+    """Draw graph unless it has been drawn already, returns the image's file name in directory."""
+    directory = directory or GRAPH_DIRECTORY
+    os.makedirs(directory, exist_ok=True)
+    fileName = traffic_cache.result_key(renderFormat=RENDER_FORMAT, graph=graph) + '.png'
+    renderExecutor.submit(store_graph, graph, os.path.join(directory, fileName), directory).result()
+    return fileName
+
+
+def evict_graphs(directory, maxBytes=GRAPH_MAX_BYTES, maxAge=GRAPH_MAX_AGE, keep=None):
+    """Remove rendered images older than maxAge, then the least recently used until they fit in maxBytes."""
+    entries = []
+    for fileName in os.listdir(directory):
+        path = os.path.join(directory, fileName)
+        if not GRAPH_FILE_NAME.match(fileName) or path == keep:
+            continue
+        try:
+            fileStat = os.stat(path)
+        except OSError:
+            continue
+        entries.append((fileStat.st_mtime, fileStat.st_size, path))
+    totalBytes = sum(size for lastUsed, size, path in entries)
+    if keep is not None and os.path.exists(keep):
+        totalBytes += os.path.getsize(keep)
+    oldest = time.time() - maxAge
+    for lastUsed, size, path in sorted(entries):
+        if lastUsed >= oldest and totalBytes <= maxBytes:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            continue
+        totalBytes -= size
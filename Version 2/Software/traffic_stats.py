@@ -0,0 +1,189 @@
+"""Statistics helpers for the optimiser.
+
+Author: Edward Upton (engiego)
+        Ben Dodd (mitgobla)
+"""
+
+import math
+
+import numpy as np
+from scipy import stats
+
+CONFIDENCE_LEVEL = 0.95
+SKETCH_RELATIVE_ACCURACY = 0.01
+# Anything at or below this, in seconds or vehicles, counts as zero in the percentile buckets.
+SKETCH_MINIMUM_VALUE = 1e-3
+SUMMARY_PERCENTILES = [50, 95, 99]
+OBJECTIVE = 'mean'
+
+
+def confidence_interval(values, confidenceLevel=CONFIDENCE_LEVEL):
+    """Mean and half width of the Student t confidence interval of the mean."""
+    count = len(values)
+    mean = sum(values) / count
+    if count < 2:
+        return mean, math.inf
+    variance = sum((value - mean) ** 2 for value in values) / (count - 1)
+    return mean, stats.t.ppf((1 + confidenceLevel) / 2, count - 1) * math.sqrt(variance / count)
+
+
+class StreamingStats():
+    """Count, mean, variance, extremes and approximate percentiles in constant memory.
+
+    The mean and variance use Welford's method with weights. Percentiles come
+    from logarithmic buckets (as in DDSketch), any percentile is within
+    relativeAccuracy of a value seen, and two StreamingStats merge exactly.
+    """
+    __slots__ = ('count', 'weight', 'mean', 'sumSquares', 'minimum', 'maximum', 'relativeAccuracy', 'logGamma', 'buckets', 'zeroWeight')
+
+    def __init__(self, relativeAccuracy=SKETCH_RELATIVE_ACCURACY):
+        self.count = 0
+        self.weight = 0.0
+        self.mean = math.nan
+        self.sumSquares = 0.0
+        self.minimum = math.nan
+        self.maximum = math.nan
+        self.relativeAccuracy = relativeAccuracy
+        self.logGamma = math.log((1 + relativeAccuracy) / (1 - relativeAccuracy))
+        self.buckets = {}
+        # Values too close to zero for a logarithmic bucket.
+        self.zeroWeight = 0.0
+
+    @classmethod
+    def from_values(cls, values, relativeAccuracy=SKETCH_RELATIVE_ACCURACY):
+        """The same as adding every value one at a time, worked out with NumPy."""
+        values = np.asarray(values, dtype=float)
+        streamingStats = cls(relativeAccuracy)
+        if values.size == 0:
+            return streamingStats
+        streamingStats.count = int(values.size)
+        streamingStats.weight = float(values.size)
+        streamingStats.mean = float(values.mean())
+        streamingStats.sumSquares = float(((values - streamingStats.mean) ** 2).sum())
+        streamingStats.minimum = float(values.min())
+        streamingStats.maximum = float(values.max())
+        positive = values > SKETCH_MINIMUM_VALUE
+        streamingStats.zeroWeight = float(values.size - positive.sum())
+        buckets, counts = np.unique(np.ceil(np.log(values[positive]) / streamingStats.logGamma).astype(int), return_counts=True)
+        streamingStats.buckets = dict(zip(buckets.tolist(), counts.astype(float).tolist()))
+        return streamingStats
+
+    def add(self, value, weight=1.0):
+        if self.count == 0:
+            self.minimum = self.maximum = value
+            self.mean = 0.0
+        elif value < self.minimum:
+            self.minimum = value
+        elif value > self.maximum:
+            self.maximum = value
+        self.count += 1
+        if weight <= 0:
+            return
+        self.weight += weight
+        delta = value - self.mean
+        self.mean += delta * weight / self.weight
+        self.sumSquares += delta * (value - self.mean) * weight
+        if value <= SKETCH_MINIMUM_VALUE:
+            self.zeroWeight += weight
+        else:
+            bucket = math.ceil(math.log(value) / self.logGamma)
+            self.buckets[bucket] = self.buckets.get(bucket, 0.0) + weight
+
+    def merge(self, other):
+        """Add everything other has seen to this, both must have the same relativeAccuracy."""
+        if other.count == 0:
+            return self
+        if self.count == 0:
+            self.minimum, self.maximum = other.minimum, other.maximum
+            self.mean = other.mean if other.weight > 0 else 0.0
+        else:
+            self.minimum = min(self.minimum, other.minimum)
+            self.maximum = max(self.maximum, other.maximum)
+        self.count += other.count
+        if other.weight > 0:
+            weight = self.weight + other.weight
+            delta = other.mean - self.mean
+            self.mean += delta * other.weight / weight
+            self.sumSquares += other.sumSquares + delta ** 2 * self.weight * other.weight / weight
+            self.weight = weight
+            self.zeroWeight += other.zeroWeight
+            for bucket, bucketWeight in other.buckets.items():
+                self.buckets[bucket] = self.buckets.get(bucket, 0.0) + bucketWeight
+        return self
+
+    def variance(self):
+        if self.weight <= 0:
+            return math.nan
+        return self.sumSquares / self.weight
+
+    def percentile(self, percent):
+        if self.weight <= 0:
+            return math.nan
+        rank = percent / 100 * self.weight
+        total = self.zeroWeight
+        if rank <= total:
+            return max(self.minimum, 0.0)
+        gamma = math.exp(self.logGamma)
+        for bucket in sorted(self.buckets):
+            total += self.buckets[bucket]
+            if rank <= total:
+                # Middle of the bucket, within relativeAccuracy of every value in it.
+                return min(max(2 * gamma ** bucket / (gamma + 1), self.minimum), self.maximum)
+        return self.maximum
+
+    def summary(self, percents=SUMMARY_PERCENTILES):
+        summary = {'count': self.count, 'mean': self.mean, 'std': math.sqrt(self.variance()) if self.weight > 0 else math.nan,
+                   'minimum': float(self.minimum), 'maximum': float(self.maximum)}
+        for percent in percents:
+            summary['p' + str(percent)] = self.percentile(percent)
+        return summary
+
+
+class LevelStats():
+    """Time weighted StreamingStats of a level, such as a queue length."""
+    __slots__ = ('stats', 'value', 'lastChange')
+
+    def __init__(self, value=0, now=0, relativeAccuracy=SKETCH_RELATIVE_ACCURACY):
+        self.stats = StreamingStats(relativeAccuracy)
+        self.value = value
+        self.lastChange = now
+
+    def set(self, value, now):
+        self.stats.add(self.value, now - self.lastChange)
+        self.value = value
+        self.lastChange = now
+
+    def until(self, now):
+        """StreamingStats up to now, including the current level."""
+        stats = StreamingStats(self.stats.relativeAccuracy).merge(self.stats)
+        stats.add(self.value, now - self.lastChange)
+        return stats
+
+
+def objective_weights(objective=OBJECTIVE):
+    """Weight of each metric in an objective given as 'mean', 'p95', 'mean+p95' or a dict of weights."""
+    if isinstance(objective, dict):
+        weights = {metric: float(weight) for metric, weight in objective.items()}
+    else:
+        metrics = objective.split('+')
+        weights = {metric: 1 / len(metrics) for metric in metrics}
+    for metric in weights:
+        if metric != 'mean' and not (metric[:1] == 'p' and metric[1:].replace('.', '', 1).isdigit() and 0 <= float(metric[1:]) <= 100):
+            raise ValueError("Unknown objective metric: " + str(metric))
+    return weights
+
+
+def light_objective(waitingTimeStats, weights):
+    return sum(weight * (waitingTimeStats.mean if metric == 'mean' else waitingTimeStats.percentile(float(metric[1:])))
+               for metric, weight in weights.items())
+
+
+def objective_value(lightWaitingStats, weights):
+    """Objective of one replication, each light counts equally as in the mean waiting time.
+
+    A light no vehicle waited at is left out, and with no vehicles at all nothing waited.
+    """
+    lightObjectives = [light_objective(waitingTimeStats, weights) for waitingTimeStats in lightWaitingStats if waitingTimeStats.count > 0]
+    if not lightObjectives:
+        return 0.0
+    return sum(lightObjectives) / len(lightObjectives)
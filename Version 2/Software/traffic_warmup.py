@@ -0,0 +1,114 @@
+"""Warm-up detection and convergence stopping for a single replication.
+
+Every replication starts with empty queues, so the early waiting times are
+lower than the steady state. The warm-up is found with MSER-5 on the total
+queue length sampled every second and vehicles arriving before it are left
+out of the waiting time. The run stops early once that estimate settles, or a
+single long run is split into batch means instead of separate replications.
+When no vehicle arriving after the warm-up has got through, the vehicles still
+queued count with the time they have waited so far, a lower bound.
+
+Author: Edward Upton (engiego)
+        Ben Dodd (mitgobla)
+"""
+
+import numpy as np
+
+import traffic_stats
+
+MSER_BATCH_SIZE = 5
+# Simulated seconds between convergence checks.
+CONVERGENCE_CHECK_INTERVAL = 500
+# Relative change in the estimate between checks that counts as converged.
+CONVERGENCE_TOLERANCE = 0.02
+# Batches a single long run is split into after the warm-up.
+BATCH_MEANS_COUNT = 20
+
+
+def mser_truncation(observations, batchSize=MSER_BATCH_SIZE):
+    """Number of leading observations to drop, chosen by MSER on batch means."""
+    batchCount = len(observations) // batchSize
+    if batchCount < 2:
+        return 0
+    batchMeans = np.asarray(observations[:batchCount * batchSize], dtype=float).reshape(batchCount, batchSize).mean(axis=1)
+    # Sums over the batches after each truncation point, worked out from the end.
+    remaining = np.arange(batchCount, 0, -1)
+    sums = np.cumsum(batchMeans[::-1])[::-1]
+    squares = np.cumsum(batchMeans[::-1] ** 2)[::-1]
+    mser = (squares - sums ** 2 / remaining) / remaining ** 2
+    # Truncating more than half the run is not trusted.
+    return int(np.argmin(mser[:batchCount // 2 + 1])) * batchSize
+
+
+def steady_state_waiting_times(queueObservations, lightDepartures, sampleInterval=1):
+    """Warm-up time and the StreamingStats of each light's waiting times for vehicles arriving after it.
+
+    lightDepartures holds a list of (arrival time, waiting time) for every light.
+    """
+    warmupTime = mser_truncation(queueObservations) * sampleInterval
+    lightWaitingStats = []
+    for departures in lightDepartures:
+        arrivalTimes, waitingTimes = np.asarray(departures, dtype=float).reshape(-1, 2).T
+        lightWaitingStats.append(traffic_stats.StreamingStats.from_values(waitingTimes[arrivalTimes >= warmupTime]))
+    return warmupTime, lightWaitingStats
+
+
+def queued_fallback(lightWaitingStats, lightQueuedWaitingTimes):
+    """lightWaitingStats with each light that has no waiting times given those of its queued vehicles instead."""
+    return [waitingTimeStats if waitingTimeStats.count > 0 else traffic_stats.StreamingStats.from_values(queuedWaitingTimes)
+            for waitingTimeStats, queuedWaitingTimes in zip(lightWaitingStats, lightQueuedWaitingTimes)]
+
+
+def run_until_converged(run_till, estimate, envTime, minTime=0, checkInterval=CONVERGENCE_CHECK_INTERVAL, tolerance=CONVERGENCE_TOLERANCE):
+    """Advance the simulation with run_till until estimate settles or envTime is reached.
+
+    estimate returns the warm-up time and the waiting time StreamingStats of each light so far.
+    Returns the last warm-up time, StreamingStats and the simulated time. The run is never
+    stopped before minTime, nor while a light has no waiting times after the warm-up. run_till
+    can return the time it aborted the run at instead, then there is no estimate to give.
+    """
+    previousWaitingTime = None
+    simulatedTime = 0
+    while simulatedTime < envTime:
+        simulatedTime = min(simulatedTime + checkInterval, envTime)
+        abortTime = run_till(simulatedTime)
+        if abortTime is not None:
+            return None, None, abortTime
+        warmupTime, lightWaitingStats = estimate()
+        if any(waitingTimeStats.count == 0 for waitingTimeStats in lightWaitingStats):
+            previousWaitingTime = None
+            continue
+        averageWaitingTime = traffic_stats.objective_value(lightWaitingStats, {'mean': 1.0})
+        if (previousWaitingTime is not None and simulatedTime >= minTime
+                and abs(averageWaitingTime - previousWaitingTime) <= tolerance * previousWaitingTime):
+            break
+        previousWaitingTime = averageWaitingTime
+    return warmupTime, lightWaitingStats, simulatedTime
+
+
+def batch_means(queueObservations, lightDepartures, runTime, batchCount=BATCH_MEANS_COUNT, weights=None, sampleInterval=1):
+    """Warm-up time, the objective of each batch of a single long run and each light's StreamingStats.
+
+    The run after the warm-up is split into batchCount equal periods by arrival
+    time. Each batch is the average over the lights of their objective (by
+    default the mean waiting time) in that period, so the batches can be
+    treated like independent replications.
+    """
+    if weights is None:
+        weights = traffic_stats.objective_weights()
+    warmupTime = mser_truncation(queueObservations) * sampleInterval
+    batchLength = (runTime - warmupTime) / batchCount
+    lightBatchValues = []
+    lightWaitingStats = []
+    for departures in lightDepartures:
+        arrivalTimes, waitingTimes = np.asarray(departures, dtype=float).reshape(-1, 2).T
+        steady = arrivalTimes >= warmupTime
+        batchNums = np.minimum(((arrivalTimes[steady] - warmupTime) // batchLength).astype(int), batchCount - 1)
+        steadyWaitingTimes = waitingTimes[steady]
+        lightBatchValues.append([traffic_stats.light_objective(traffic_stats.StreamingStats.from_values(steadyWaitingTimes[batchNums == batchNum]), weights)
+                                 for batchNum in range(batchCount)])
+        lightWaitingStats.append(traffic_stats.StreamingStats.from_values(steadyWaitingTimes))
+    lightBatchValues = np.array(lightBatchValues)
+    # A light with no vehicles in a batch is left out of that batch rather than counted as no waiting.
+    batchValues = [float(np.nanmean(batch)) for batch in lightBatchValues.T if not np.isnan(batch).all()]
+    return warmupTime, batchValues, lightWaitingStats